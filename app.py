@@ -1,5 +1,6 @@
 import os
-import json
+import math
+import uuid
 import yaml
 import click
 from loguru import logger
@@ -8,17 +9,23 @@ from time import perf_counter
 from datetime import datetime, timedelta
 
 import dash
+import numpy as np
 import dash_leaflet as dl
-import dash_ag_grid as dag
 import dash_bootstrap_components as dbc
-from dash import dcc, html, Input, Output, State, Patch
+from dash import dcc, html, Input, Output, State
 
 from src.gemini.rag import RAG
 from src.gemini.similarity_search import SimilaritySearch
+from src.gemini.rate_control import install_rate_controller
 
 from src.app.chart import generate_chart
-from src.app.grid import render_message_html
-from src.app.map import get_geoconfirmed_locations, get_telegram_locations
+from src.app.grid import generate_grid, card_fields, query_messages
+from src.app.map import get_geoconfirmed_locations, geoconfirmed_files, telegram_location
+from src.app.columnar import load_columnar
+from src.app.time_index import TimeWindowIndex
+from src.app.session_cache import SessionCache
+from src.app.memo import MemoCache, deep_sizeof
+from src.data_telegram.search_index import SearchIndex, fts_query
 
 # --- List of datamaps ---
 
@@ -33,6 +40,98 @@ with open('./config.yaml') as f:
 rag = RAG(GOOGLE_API_KEY=GOOGLE_API_KEY)
 similarity_search = SimilaritySearch(GOOGLE_API_KEY=GOOGLE_API_KEY)
 
+# Retry on 429/503 with the rate controller of src/gemini
+install_rate_controller()
+
+# --- Datamaps loaded by this process ---
+
+# Name of the datamap -> its memory-mapped messages, its Geoconfirmed events and their time index, shared by all sessions.
+# The cap bounds the memory held by the loaded datamaps, not their mapped columns (see sizeof_datamap)
+datamap_memo = MemoCache(max_bytes=2 * 1024 ** 3)
+
+def load_datamap(datamap: str) -> dict:
+    tic = perf_counter()
+    messages = load_columnar(os.path.join('./data/datamaps', datamap), 'gemini')
+    geoconfirmed = sorted(get_geoconfirmed_locations(datamap), key=lambda item: item['date'])
+    logger.debug(f"Elapsed time for loading datamap {datamap}: {perf_counter() - tic:0.3f} sec")
+    return {'messages': messages, 'geoconfirmed': geoconfirmed, 'index': TimeWindowIndex.of_datamap(messages, geoconfirmed),
+            'search': SearchIndex(os.path.join(messages.directory, 'search.sqlite'))}
+
+def sizeof_datamap(loaded: dict) -> int:
+    """
+    Estimate the memory held by a loaded datamap: its Geoconfirmed events, the arrays of its time index built in memory
+    and the page cache of the connection to its full-text index.
+    All the columns (including the UTF-8 blobs and the offsets of the strings) are memory-mapped and not counted: their pages
+    belong to the page cache of the OS, which evicts them under pressure, and the strings are only decoded for the rows of a window.
+    """
+    index = sum(ts.nbytes for ts in loaded['index'].ts.values() if not isinstance(ts, np.memmap))
+    return deep_sizeof(loaded['geoconfirmed']) + index + loaded['search'].cache_bytes() + deep_sizeof(loaded['messages'].meta)
+
+def get_datamap(datamap: str) -> dict:
+    """
+    Load a datamap once per process (and again if one of its files changed): every window-driven callback then only reads the rows of its window
+    """
+    datamap_dir = os.path.join('./data/datamaps', datamap)
+    sources = [os.path.join(datamap_dir, 'telegram_gemini.json'), os.path.join(datamap_dir, 'columnar_gemini', 'CURRENT'),
+               os.path.join(datamap_dir, 'datamap-config.yaml')] + geoconfirmed_files(datamap)
+    return datamap_memo.get(datamap, sources, lambda: load_datamap(datamap), sizeof_datamap)
+
+# Messages of the current window of each session: the browser only holds the session id and the window bounds
+session_cache = SessionCache(max_entries=32)
+
+def get_window_entry(session_id: str, window: dict) -> dict:
+    """
+    Return the entry of the session cache holding the messages of a window {'datamap', 'start', 'end'} (epochs),
+    filled with them if the window changed
+    """
+    entry = session_cache.get(session_id, window['datamap'])
+    loaded = get_datamap(window['datamap'])
+    if (entry.get('window') != (window['start'], window['end'])) or (entry.get('loaded') is not loaded):
+        rows = loaded['index'].messages(window['start'], window['end'])
+        entry['window'], entry['loaded'], entry['rows'] = (window['start'], window['end']), loaded, (rows.start, rows.stop)
+        entry['messages'] = loaded['messages'].records(rows)
+        entry.pop('query', None)
+    return entry
+
+def get_window_messages(session_id: str, window: dict) -> list[dict]:
+    """
+    Return the messages of a window {'datamap', 'start', 'end'} (epochs), from the cache of the session if possible
+    """
+    return get_window_entry(session_id, window)['messages']
+
+# --- Feed ---
+
+# The feed is served page by page: AG Grid only measures the height of the cards of a page
+PAGE_SIZE = 100
+DEFAULT_QUERY = {'account': None, 'text': None, 'similar': None, 'descending': False}
+
+def get_feed_messages(session_id: str, window: dict, query: dict) -> list[dict]:
+    """
+    Return the messages of the feed for a query (account, quick filter, similar messages and order), evaluated on the server
+    and cached in the session until the window or the query changes
+    """
+    # The entry is kept for the whole request: a concurrent request may evict it from the session cache meanwhile
+    entry = get_window_entry(session_id, window)
+    messages = entry['messages']
+    if entry.get('query') != query:
+        loaded = get_datamap(window['datamap'])
+
+        # Similar messages are searched in the whole datamap, and kept in their order of similarity
+        if query['similar']:
+            rows, messages = query['similar'], loaded['messages'].records(query['similar'])
+            search_rows = (None, None)
+        else:
+            rows, search_rows = range(*entry['rows']), entry['rows']
+
+        # Keywords are searched in the full-text index, within the rows of the window
+        if query['text']:
+            matches = set(loaded['search'].search(query['text'], *search_rows, account=query['account']))
+            messages = [message for row, message in zip(rows, messages) if row in matches]
+
+        entry['query'] = query
+        entry['feed'] = query_messages(messages, query['account'], query['descending'] and not query['similar'])
+    return entry['feed']
+
 # --- Initialize Dash app ---
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.DARKLY])
@@ -41,7 +140,7 @@ app.title = 'Telegram Feed Analyzer'
 CARD_STYLE = {'backgroundColor': '#3c3c3c', 'borderRadius': '8px', 'padding': '8px', 'height': '100%', 'margin':'0px'}
 LABEL_STYLE = {'marginBottom': '4px', 'fontWeight': 'bold', 'fontSize': '16px'}
 
-app.layout = dbc.Container([
+layout = dbc.Container([
 
     # Header
     dbc.Row([
@@ -125,12 +224,11 @@ app.layout = dbc.Container([
 
     # Horizontal rule
     html.P(id='messages-stat', style={'fontSize': '12px', 'marginLeft': '8px','fontFamily': 'monospace'}),
-    dcc.Store(id='all_messages'),
-    dcc.Store(id='all_telegram_locations'),
-    dcc.Store(id='all_geoconfirmed_locations'),
-    dcc.Store(id='messages'),  # TODO: check if faster if store the whole dataset
-    dcc.Store(id='messages-dag-init'),
+    dcc.Store(id='loaded-datamap'),
+    dcc.Store(id='messages'),  # bounds of the current window, its messages are in the session cache
     dcc.Store(id='is_filtered', data=False),
+    dcc.Store(id='feed-query', data=DEFAULT_QUERY),
+    dcc.Store(id='feed-page', data=0),
     html.Hr(style={'marginTop': '8px','marginBottom': '16px'}),
 
     # Main Content
@@ -145,9 +243,15 @@ app.layout = dbc.Container([
 
                     # Messages with dag
                     dcc.Loading(
-                        html.Div([dag.AgGrid(id='messages-dag')], id='messages-feed', style={'height': '80vh', 'marginx': '8px'}), 
-                        style={'height': '80vh', 'marginx': '8px'}
+                        html.Div([generate_grid()], id='messages-feed', style={'height': '76vh', 'marginx': '8px'}), 
+                        style={'height': '76vh', 'marginx': '8px'}
                     ),
+                    html.Div([
+                        html.Button('\u2039', id='previous-page', title='Previous messages', style={'paddingLeft': '8px', 'paddingRight': '8px', 'borderRadius': '4px', 'fontFamily': 'monospace'}),
+                        html.Span(id='page-stat', className='text-center', style={'flex': 1, 'fontSize': '12px', 'fontFamily': 'monospace'}),
+                        html.Button('\u203a', id='next-page', title='Next messages', style={'paddingLeft': '8px', 'paddingRight': '8px', 'borderRadius': '4px', 'fontFamily': 'monospace'}),
+                        html.Button('\u21c5', id='sort-button', title='Newest first', style={'paddingLeft': '8px', 'paddingRight': '8px', 'borderRadius': '4px', 'marginLeft': '4px'}),
+                    ], className='d-flex align-items-center', style={'margin-top': '8px'}),
                     html.Button('Reset filters \u27f3', id='reset-button', style={'width': '100%', 'backgroundColor': 'grey', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px'})
                 ]),
 
@@ -213,6 +317,14 @@ app.layout = dbc.Container([
 
 ], fluid=True)
 
+def serve_layout():
+    """
+    Return the layout with a new session id at each page load
+    """
+    return html.Div([dcc.Store(id='session-id', data=str(uuid.uuid4())), layout])
+
+app.layout = serve_layout
+
 # --- Callbacks for the header ---
 
 @app.callback(
@@ -264,114 +376,102 @@ def update_date(increase_clicks, decrease_clicks, current_date):
 # --- Callbacks for the Telegram messages feed ---
 
 @app.callback(
-    Output('all_messages', 'data'),
+    Output('loaded-datamap', 'data'),
     Input('datamap', 'value'),
     prevent_initial_call=True
 )
 def load_all_messages(datamap: Optional[str]):
 
     if datamap:
-        tic = perf_counter()
-
-        with open(os.path.join('./data/datamaps', datamap, 'telegram_gemini.json'), 'r', encoding='utf-8') as f:
-            all_messages = json.load(f)
-
-        # Add additional columns for rendering
-        for idx, message in enumerate(all_messages):
-            all_messages[idx]['message_html'] = render_message_html(message)
-        logger.debug(f"Elapsed time for load_all_messages: {perf_counter() - tic:0.3f} sec")
-
-        return all_messages
+        get_datamap(datamap)
+        return datamap
     return dash.no_update
 
 @app.callback(
     Output('messages-stat', 'children'),
     Output('messages', 'data'),
-    Input('datamap', 'value'),
+    Input('loaded-datamap', 'data'),
     Input('date-input', 'value'),
     Input('duration-input', 'value'), 
-    Input('all_messages', 'data'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def load_messages(datamap: Optional[str], date_start: Optional[str], duration: Optional[int], all_messages):
+def load_messages(datamap: Optional[str], date_start: Optional[str], duration: Optional[int], session_id: str):
 
 
     if datamap and date_start and duration:
         tic = perf_counter()
 
-        # Filter dates
-        date_start = datetime.strptime(date_start, '%Y-%m-%d %H:%M')
-        date_end = date_start + timedelta(hours=duration)
+        # Binary search of the window in the time index
+        start, end = TimeWindowIndex.window(date_start, duration)
+        window = {'datamap': datamap, 'start': start, 'end': end}
+        messages = get_window_messages(session_id, window)
 
-        date_start, date_end = date_start.strftime('%Y-%m-%d %H:%M'), date_end.strftime('%Y-%m-%d %H:%M')
-        messages = [m for m in all_messages if date_start <= m['date'] < date_end]
+        date_end = (datetime.strptime(date_start, '%Y-%m-%d %H:%M') + timedelta(hours=duration)).strftime('%Y-%m-%d %H:%M')
         messages_stat = f'Number of Telegram messages in map {datamap} between {date_start} and {date_end}: {len(messages)}'
 
         logger.debug(f"Elapsed time for load_messages: {perf_counter() - tic:0.3f} sec")
 
-        return messages_stat, messages
+        return messages_stat, window
     
     else:
 
         return dash.no_update, dash.no_update
 
 @app.callback(
-    Output('messages-feed', 'children', allow_duplicate=True), 
-    Output('messages-dag-init', 'data'),
-    Input('messages', 'data'), 
+    Output('messages-dag', 'rowData'),
+    Output('messages-dag', 'scrollTo'),
+    Output('feed-page', 'data'),
+    Output('page-stat', 'children'),
+    Input('messages', 'data'),
+    Input('feed-query', 'data'),
+    Input('previous-page', 'n_clicks'),
+    Input('next-page', 'n_clicks'),
+    State('feed-page', 'data'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def create_grid(messages):
-    
-    tic = perf_counter()
+def serve_rows(window, query, previous_clicks, next_clicks, page, session_id):
+    """
+    Serve the page of the feed, for the current window and query
+    """
+    if not window:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
-    columnDefs = [
-    {'field': 'message_html', 'cellRenderer': 'RenderHTML'},
-    {'field': 'account', 'hide': True},  # Invisible column
-    {'field': 'sim', 'hide': True},  # Invisible column
-    {'field': 'date', 'hide': True},  # Invisible column
-    {'field': 'text_english', 'hide': True}  # Invisible column
-    ]
-
-    grid = dag.AgGrid(
-        id='messages-dag',
-        columnDefs=columnDefs,
-        rowData=messages,
-        columnSize='responsiveSizeToFit',
-        dashGridOptions={
-            'headerHeight':0, 
-            'rowStyle': {'border': 'none'},
-            'suppressCellFocus': True
-            },
-        style={'height': '100%', 'width': '100%'},
-        className='no-border-grid',
-        defaultColDef={
-            'sortable': True, 'filter': True,
-            'cellStyle': {'backgroundColor': '#3c3c3c', 'color': 'white', 'padding': '0px'},
-            'wrapText': True,  # Ensure text wraps within the cell
-            'autoHeight': True  # Automatically adjust the height of the row based on content
-        }
-    )
+    tic = perf_counter()
+    feed = get_feed_messages(session_id, window, query)
+    n_pages = max(math.ceil(len(feed) / PAGE_SIZE), 1)
+
+    # A new window or a new query starts again from the first page
+    button_id = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
+    if button_id == 'previous-page':
+        page = max(page - 1, 0)
+    elif button_id == 'next-page':
+        page = min(page + 1, n_pages - 1)
+    else:
+        page = 0
 
-    logger.debug(f"Elapsed time for create_grid: {perf_counter() - tic:0.3f} sec")
+    rows = feed[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+    page_stat = f'{page * PAGE_SIZE + 1}-{page * PAGE_SIZE + len(rows)} of {len(feed)}' if rows else '0 of 0'
+    logger.debug(f"Elapsed time for serve_rows: {perf_counter() - tic:0.3f} sec")
 
-    return grid, grid
+    return [card_fields(message) for message in rows], {'rowIndex': 0}, page, page_stat
 
 @app.callback(
-    Output('messages-dag', 'filterModel'),
-    Output('messages-dag', 'rowData', allow_duplicate=True),
+    Output('feed-query', 'data'),
     Output('reset-button', 'style'),
     Output('is_filtered', 'data'),
     Output('map', 'center', allow_duplicate=True),
     Output('map', 'zoom', allow_duplicate=True),
     Input('messages-dag', 'cellRendererData'),
-    Input('is_filtered', 'data'),
-    State('messages-dag', 'rowData'),
-    State('all_messages', 'data'),
+    State('is_filtered', 'data'),
+    State('feed-query', 'data'),
+    State('feed-page', 'data'),
+    State('messages', 'data'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def update_grid(cellRendererData, is_filtered, current_row_data, all_messages):
-    # FIXME: should use all_row_data
+def update_grid(cellRendererData, is_filtered, query, page, window, session_id):
 
     style_common = {'width': '100%', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px'}
 
@@ -379,17 +479,17 @@ def update_grid(cellRendererData, is_filtered, current_row_data, all_messages):
         # Click to filter on account
         if ('filterAccount' in cellRendererData['value']) and (not is_filtered):
 
-            filter_model = {'account': {'filterType': 'text', 'type': 'equals', 
-                                        'filter': cellRendererData['value']['filterAccount']}}
+            query = query | {'account': cellRendererData['value']['filterAccount']}
 
-            return filter_model, dash.no_update, style_common | {'backgroundColor': '#4CAF50'}, True, dash.no_update, dash.no_update
+            return query, style_common | {'backgroundColor': '#4CAF50'}, True, dash.no_update, dash.no_update
 
         # Click to find similar messages
         elif ('showSimilar' in cellRendererData['value']) and (not is_filtered):
 
             # Format the message 
-            idx = cellRendererData['rowIndex']
-            message, date = all_messages[idx]['text_english'],  all_messages[idx]['date']
+            idx = page * PAGE_SIZE + cellRendererData['rowIndex']
+            message = get_feed_messages(session_id, window, query)[idx]
+            message, date = message['text_english'], message['date']
             query_message = f"[Date: {date}] {message}"
             logger.info(f"Search for similar message for idx {idx}, {date}")
 
@@ -397,38 +497,51 @@ def update_grid(cellRendererData, is_filtered, current_row_data, all_messages):
             results = similarity_search.query(query_message, n_results=100)
             indices = [int(mid) for mid in results['ids'][0]]
 
-            return dash.no_update, [current_row_data[i] for i in indices], style_common | {'backgroundColor': '#4CAF50'}, True, dash.no_update, dash.no_update
+            return query | {'similar': indices}, style_common | {'backgroundColor': '#4CAF50'}, True, dash.no_update, dash.no_update
 
         elif 'zoomLoc' in cellRendererData['value']:
 
             lat, lon, _ = cellRendererData['value']['zoomLoc']
             lat, lon = float(lat), float(lon)
 
-            return dash.no_update, dash.no_update, dash.no_update, dash.no_update, (lat, lon), 14
+            return dash.no_update, dash.no_update, dash.no_update, (lat, lon), 14
 
     # When we click on reset or if we try to filter again 
-    return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
 @app.callback(
-    Output('messages-dag', 'dashGridOptions'),
+    Output('feed-query', 'data', allow_duplicate=True),
     Input('quick-filter-input', 'value'),
+    State('feed-query', 'data'),
+    prevent_initial_call=True
+)
+def update_filter(filter_value, query):
+    # A text without any word to search (e.g. being typed) does not filter the feed
+    return query | {'text': filter_value if filter_value and fts_query(filter_value) else None}
+
+@app.callback(
+    Output('feed-query', 'data', allow_duplicate=True),
+    Output('sort-button', 'title'),
+    Input('sort-button', 'n_clicks'),
+    State('feed-query', 'data'),
     prevent_initial_call=True
 )
-def update_filter(filter_value):
-    newFilter = Patch()
-    newFilter['quickFilterText'] = filter_value
-    return newFilter
+def update_sort(n_clicks, query):
+    query = query | {'descending': not query['descending']}
+    return query, 'Oldest first' if query['descending'] else 'Newest first'
 
 @app.callback(
-    Output('messages-feed', 'children'),
+    Output('feed-query', 'data', allow_duplicate=True),
     Output('is_filtered', 'data', allow_duplicate=True),
     Output('reset-button', 'style', allow_duplicate=True),
     Input('reset-button', 'n_clicks'),
-    State('messages-dag-init', 'data'),
+    State('feed-query', 'data'),
     prevent_initial_call=True
 )
-def reset_grid(n_clicks, initial_grid):
-    return initial_grid, False, {'width': '100%', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px', 'backgroundColor': 'grey'}
+def reset_grid(n_clicks, query):
+    # The quick filter is kept, as it is still displayed in its input
+    query = DEFAULT_QUERY | {'text': query['text'], 'descending': query['descending']}
+    return query, False, {'width': '100%', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px', 'backgroundColor': 'grey'}
 
 # --- Callbacks for the RAG system --
 
@@ -479,57 +592,30 @@ def view_map(datamap):
     return dash.no_update, dash.no_update
     
 
-@app.callback(
-    Output('all_telegram_locations', 'data'),
-    Input('all_messages', 'data'),
-    prevent_initial_call=True
-)
-def load_telegram_locations(all_messages):
-
-    logger.info('Load Telegram all locations')
-    
-    if all_messages:
-        return get_telegram_locations(all_messages)
-    return []
-
-@app.callback(
-    Output('all_geoconfirmed_locations', 'data'),
-    Input('datamap', 'value'),
-    prevent_initial_call=True
-)
-def load_geoconfirmed_locations(datamap: Optional[str]):
-    
-    if datamap:
-        tic = perf_counter()
-        locs = get_geoconfirmed_locations(datamap)
-        logger.debug(f"Elapsed time for load_geoconfirmed_locations: {perf_counter() - tic:0.3f} sec")
-
-        return locs
-    
-    return []
-
 @app.callback(
     Output('telegram-layer', 'children'),
     Output('geoconfirmed-layer', 'children'),
     Input('date-input', 'value'),
     Input('duration-input', 'value'),
-    Input('all_telegram_locations', 'data'),
-    Input('all_geoconfirmed_locations', 'data'),
+    Input('loaded-datamap', 'data'),
     prevent_initial_call=True
 )
-def update_telegram_markers(date_start, duration, all_telegram_locations, all_geoconfirmed_locations):
-
-    if date_start and duration:
-        # Datetimes
-        dt_start = datetime.strptime(date_start, '%Y-%m-%d %H:%M')
-        dt_end = dt_start + timedelta(hours=duration) - timedelta(seconds=1)
+def update_telegram_markers(date_start, duration, datamap):
 
-        # String format %Y-%m-%d %H:%M to filter Telegram posts
-        date_end = datetime.strftime(dt_end, '%Y-%m-%d %H:%M')
-
-        # String format %Y-%m-%d to filter Geoconfirmed posts
-        day_start = datetime.strftime(dt_start, '%Y-%m-%d')
-        day_end = datetime.strftime(dt_end, '%Y-%m-%d')
+    if datamap and date_start and duration:
+        loaded = get_datamap(datamap)
+        messages, index = loaded['messages'], loaded['index']
+        start, end = TimeWindowIndex.window(date_start, duration)
+
+        # Only the locations of the window are read from the columns
+        telegram_locations = index.telegram_locations(start, end)
+        rows = messages['loc_message'][telegram_locations]
+        lats, lons = messages['loc_lat'][telegram_locations], messages['loc_lon'][telegram_locations]
+        all_telegram_locations = [
+            telegram_location(messages.string('account', row), int(messages['id'][row]), messages.string('date', row),
+                              messages.string('text_english', row), float(lat), float(lon))
+            for row, lat, lon in zip(rows, lats, lons)
+        ]
 
         filtered_telegram_locs = [
             dl.Marker(
@@ -537,7 +623,7 @@ def update_telegram_markers(date_start, duration, all_telegram_locations, all_ge
                 children=[dl.Tooltip(item['tooltip']), dl.Popup(item['popup'])],
                 icon = dict(iconUrl='assets/marker-icon-blue.png', iconAnchor=(12, 18))
             )
-            for item in all_telegram_locations if date_start <= item["date"] < date_end
+            for item in all_telegram_locations
         ]
 
         filtered_geoconfirmed_locs = [
@@ -546,7 +632,7 @@ def update_telegram_markers(date_start, duration, all_telegram_locations, all_ge
                 children=[dl.Tooltip(item['tooltip']), dl.Popup(item['popup'])],
                 icon = dict(iconUrl='assets/marker-icon-red.png', iconAnchor=(12, 18))
             )
-            for item in all_geoconfirmed_locations if day_start <= item["date"] <= day_end  # TODO: check
+            for item in loaded['geoconfirmed'][index.geoconfirmed(start, end)]
         ]
 
         return filtered_telegram_locs, filtered_geoconfirmed_locs
@@ -559,11 +645,14 @@ def update_telegram_markers(date_start, duration, all_telegram_locations, all_ge
     Output('sentiment-chart', 'figure'),
     Input('messages', 'data'),
     Input('interval', 'value'),
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def update_sentiment_chart(messages, interval):
+def update_sentiment_chart(window, interval, session_id):
+    if not window:
+        return dash.no_update
     tic = perf_counter()
-    chart = generate_chart(messages, interval)
+    chart = generate_chart(get_window_messages(session_id, window), interval)
     logger.debug(f"Elapsed time for chart: {perf_counter() - tic:0.3f} sec")
     return chart
 
@@ -1,27 +1,67 @@
 var dagcomponentfuncs = (window.dashAgGridComponentFunctions = window.dashAgGridComponentFunctions || {});
 
-dagcomponentfuncs.RenderHTML = function (props) {
-    const { data, setData } = props;
-
-    const handleClick = (event) => {
-        const target = event.target;
+function sentimentToColor(neg, neu, pos) {
+    if (neu > Math.max(neg, pos)) {
+        return 'rgba(255,255,255,1.0)';
+    }
+    return `rgba(${Math.floor(neg * 255)}, ${Math.floor(pos * 255)}, 0, 1.0)`;
+}
 
-        if (target.classList.contains('user-icon')) {
-            setData({ filterAccount: data.account }); // Use a different key to avoid conflict
+function icon(src, props) {
+    return React.createElement('img', Object.assign({ src: src, height: 16 }, props));
+}
 
-        } else if (target.classList.contains('similar-icon')) {
-            setData({ showSimilar: true }); // Signal to show similar messages
+// Card of a Telegram message, built from its compact fields (see CARD_FIELDS in src/app/grid.py)
+dagcomponentfuncs.MessageCard = function (props) {
+    const { data, setData } = props;
+    const e = React.createElement;
+    const url = `https://t.me/${data.account}/${data.id}`;
+    const tooltipStyle = { fontSize: '10px', width: '140px', backgroundColor: '#c2c2c2', color: 'black', textAlign: 'center', borderRadius: '5px', padding: '5px' };
 
-        } else if (target.classList.contains('location-icon')) {
-            setData({ zoomLoc: [target.dataset.lat, target.dataset.lon, target.title] });
-        }
-    };
+    const locations = (data.coordinates || []).map(([lat, lon], k) =>
+        icon('./assets/location_r.png', {
+            key: `loc-${k}`, title: data.geolocs[k], className: 'location-icon',
+            style: { marginRight: '5px', cursor: 'pointer' },
+            onClick: () => setData({ zoomLoc: [lat, lon, data.geolocs[k]] })
+        })
+    );
+    if (data.has_photo) {
+        locations.push(icon('./assets/photo_r.png', { key: 'photo', style: { marginRight: '5px' } }));
+    }
+    if (data.has_video) {
+        locations.push(icon('./assets/video_r.png', { key: 'video' }));
+    }
 
-    return React.createElement(
-        'div',
-        {
-            dangerouslySetInnerHTML: { __html: props.value },
-            onClick: handleClick // Add the click listener to the container
+    return e('div', {
+        style: {
+            backgroundColor: '#2c2c2c', borderLeft: `5px solid ${sentimentToColor(data.negative, data.neutral, data.positive)}`,
+            padding: '10px', marginBottom: '8px', marginRight: '8px', borderRadius: '4px', color: 'white'
         }
+    },
+        e('div', { style: { display: 'flex', justifyContent: 'space-between', alignItems: 'center' } },
+            e('div', { style: { display: 'flex', alignItems: 'center', position: 'relative' } },
+                icon('./assets/user_r.png', {
+                    className: 'tooltiptext user-icon', style: { marginRight: '5px', cursor: 'pointer' },
+                    onClick: () => setData({ filterAccount: data.account })
+                }),
+                e('span', { className: 'hide', style: Object.assign({ position: 'absolute', top: '1px', left: '30px' }, tooltipStyle) }, `Filter on user ${data.account}`),
+                e('span', null, data.account)
+            ),
+            e('div', { style: { display: 'flex', alignItems: 'center', marginLeft: 'auto' } },
+                e('a', { href: url, target: '_blank' }, icon('./assets/link_r.png', { style: { marginRight: '5px' } })),
+                e('span', null, data.date)
+            )
+        ),
+        e('div', { style: { marginTop: '5px', marginBottom: '5px' } }, data.text_english),
+        e('div', { style: { display: 'flex', gap: '5px' } },
+            e('div', { style: { display: 'flex', alignItems: 'center' } }, locations),
+            e('div', { style: { marginLeft: 'auto', cursor: 'pointer', marginRight: 0 } },
+                icon('./assets/similar_r.png', {
+                    className: 'tooltiptext similar-icon', style: { marginRight: '-120px', cursor: 'pointer' },
+                    onClick: () => setData({ showSimilar: true })
+                }),
+                e('span', { className: 'hide', style: Object.assign({ position: 'relative', top: '0px', right: '40px' }, tooltipStyle) }, 'Search for similar messages')
+            )
+        )
     );
 };
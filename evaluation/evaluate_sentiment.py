@@ -1,3 +1,4 @@
+import sys
 import json
 import yaml
 import enum
@@ -5,9 +6,11 @@ import click
 from tqdm import tqdm
 from google import genai
 from google.genai import types
-from google.api_core import retry
 from collections import Counter
 
+sys.path.append('..')
+from src.gemini.rate_control import install_rate_controller
+
 
 class AnswerComparison(enum.Enum):
   A = 'A'
@@ -15,12 +18,8 @@ class AnswerComparison(enum.Enum):
   B = 'B'
 
 
-def is_retriable(e):
-    return isinstance(e, genai.errors.APIError) and e.code in {429, 503}
-
-if not hasattr(genai.models.Models.generate_content, '__wrapped__'):
-  genai.models.Models.generate_content = retry.Retry(
-      predicate=is_retriable)(genai.models.Models.generate_content)
+# Retry on 429/503 with the rate controller of src/gemini
+install_rate_controller()
 
 
 
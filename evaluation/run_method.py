@@ -8,14 +8,11 @@ from google import genai
 from loguru import logger
 
 sys.path.append('..')
+from src.gemini.quota import MODEL_QUOTAS
 from src.gemini.structured_output import structured_analysis, COMBINED_PROMPT
 
-LIST_GEMINI = ['gemini-2.0-flash', 'gemini-2.0-flash-lite', 'gemini-2.5-flash-preview-04-17', 'gemini-1.5-flash']
-
-# 'gemini-2.0-flash-lite': 30/min, 1500/day
-# 'gemini-2.0-flash': 15/min, 1000/day
-# 'gemini-1.5-flash': 15/min, 500/day
-# 'gemini-2.5-flash-preview-04-17': 10/min, 500/day
+# See MODEL_QUOTAS for the limits of each model (e.g. 'gemini-2.0-flash-lite': 30/min, 1500/day)
+LIST_GEMINI = list(MODEL_QUOTAS)
 
 
 @click.command()
@@ -41,7 +38,7 @@ def main(method):
     # Prediction over each message
     for i, message in tqdm(enumerate(messages), total=len(messages)):
 
-        output = structured_analysis(client, message['text'], prompt_template=COMBINED_PROMPT, region=REGION, languages=LANGUAGES, model_google=method)
+        output = structured_analysis(client, message['text'], prompt_template=COMBINED_PROMPT, region=REGION, languages=LANGUAGES, model_google=method, use_cache=False, preclassify=False)
         if output:
             messages[i] =  message | {'text_english': output['translation'], 
             'geolocs': [g['location_name'] for g in output['geolocations']], 
@@ -1,14 +1,19 @@
 import os
 import yaml
-import json
 import click
 import asyncio
 from google import genai
 from loguru import logger
+from collections import deque, defaultdict
 from zoneinfo import ZoneInfo
+from datetime import datetime
 from telethon.sync import TelegramClient, events
 
-from src.gemini.structured_output import structured_analysis, COMBINED_PROMPT
+from src.gemini.structured_output import async_structured_analysis_batch, format_output, COMBINED_PROMPT, TRANSLATION_PROMPT, EMPTY_ANALYSIS
+from src.gemini.cascade import async_cascade_analysis, cascade_stats, CASCADE_MODELS
+from src.data_telegram.live_ingestion import LiveIngestion, backfill, LOW, CATCH_UP
+from src.data_telegram.store import LiveStore
+from src.data_telegram.entity_cache import EntityCache
 
 
 # Collect keys for Telegram and Gemini AI
@@ -21,27 +26,60 @@ with open("config.yaml") as file:
 
     GOOGLE_API_KEY = config['secret_keys']['google']['api_key']
 
+# Enhanced fields of a message when the analysis failed
+FAILED_ANALYSIS = {'text_english': '', 'geolocs': [], 'coordinates': [], 'negative': 0.33, 'neutral': 0.34, 'positive': 0.33}
+
+# Raw fields of a message, as put in the queue by LiveIngestion
+RAW_FIELDS = ['account', 'id', 'date', 'text', 'has_photo', 'has_video']
+
+
 @click.command()
 @click.option('--datamap', required=True, help="Name of the folder")
-def main(datamap):
-    asyncio.run(run(datamap))
+@click.option('--workers', default=4, show_default=True, help="Number of workers calling Gemini concurrently")
+@click.option('--batch-size', default=8, show_default=True, help="Maximal number of messages analyzed in a single request when the queue is deep")
+@click.option('--queue-size', default=10_000, show_default=True, help="Maximal number of messages waiting for an analysis")
+@click.option('--no-backfill', is_flag=True, help="Do not catch up the messages posted while the live was down")
+def main(datamap, workers, batch_size, queue_size, no_backfill):
+    asyncio.run(run(datamap, workers, batch_size, queue_size, no_backfill))
+
+
+class LiveStats:
+    """
+    Queue depth and end-to-end lag (date of the message on Telegram -> write of its analysis) of the live, by priority
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        self.lags = defaultdict(lambda: deque(maxlen=maxlen))  # in seconds, for the last messages written
+        self.n_written, self.n_batches, self.n_deferred, self.n_caught_up = 0, 0, 0, 0
+
+    def record(self, date_utc: datetime, priority: int):
+        self.lags[priority].append((datetime.now(ZoneInfo("UTC")) - date_utc).total_seconds())
+        self.n_written += 1
 
+    def summary(self, queue: asyncio.Queue, deferred: deque) -> str:
+        lags = []
+        for priority, values in sorted(self.lags.items()):
+            values = sorted(values)
+            lags.append(f"priority {priority}: median {values[len(values) // 2]:0.1f} sec, max {values[-1]:0.1f} sec")
+        return (f"queue depth {queue.qsize()}, {self.n_written} messages written ({self.n_batches} batches), "
+                f"{self.n_deferred} deferred ({len(deferred)} waiting, {self.n_caught_up} caught up), lag {'; '.join(lags) or 'n/a'}")
 
-async def run(datamap):
+
+async def run(datamap, workers=4, batch_size=8, queue_size=10_000, no_backfill=False):
     # Collect information about the live
     with open(os.path.join('./data/datamaps/', datamap, 'datamap-config.yaml')) as file:
         datamap_config  = yaml.safe_load(file)
 
         REGION = datamap_config['map']['region']
         LANGUAGES = datamap_config['map']['languages']
+        BBOX = datamap_config['map'].get('bbox')
         CHANNELS = datamap_config['telegram']
         TIMEZONE = datamap_config['date']['timezone']
+        PRIORITIES = datamap_config.get('live', {}).get('priorities', {})
+        BACKLOG = datamap_config.get('live', {}).get('backlog', 50)
 
-    # Create a JSON file if it does not exist
-    jsonl_path = os.path.join('./data/datamaps/', datamap, 'telegram_gemini.jsonl')
-    if not os.path.exists(jsonl_path):
-        with open(jsonl_path, 'w', encoding='utf-8') as f:
-            f.write('')
+    # Store of the enhanced messages, shared with the dashboard
+    store = LiveStore.of_datamap(os.path.join('./data/datamaps/', datamap))
 
     client = TelegramClient('live', API_ID, API_HASH)
     logger.success("Connected to Telegram")
@@ -49,59 +87,189 @@ async def run(datamap):
     client_genai = genai.Client(api_key=GOOGLE_API_KEY)
     logger.success("Connected to Google API")
 
+    # Handlers only put the new messages in the queue, so that the event loop is never blocked by Gemini.
+    # Messages are served by priority of their channel, then in their order of arrival.
+    queue = asyncio.PriorityQueue(maxsize=queue_size)
+    last_ids = store.last_ids()
+    ingestion = LiveIngestion(queue, TIMEZONE, PRIORITIES, watermarks=last_ids)
+    deferred = deque()  # messages only translated under backlog, analyzed again when the queue is empty
+    stats = LiveStats()
+
+    # Messages deferred before a restart are still waiting for their complete analysis
+    for record in store.deferred():
+        deferred.append((CATCH_UP, 0, {field: record[field] for field in RAW_FIELDS if field in record}, None))
+    if deferred:
+        logger.info(f"{len(deferred)} deferred messages of the store to analyze again")
+
+    # The account of a new message is resolved from its chat_id, without any request to Telegram
+    entities = EntityCache(os.path.join('./data/datamaps/', datamap, 'entities.json'))
+    warmed = asyncio.Event()
+
     @client.on(events.NewMessage(chats=CHANNELS))
     async def handler(event):
-        await new_message_handler(event, datamap, client_genai, COMBINED_PROMPT, REGION, LANGUAGES, TIMEZONE)
+        await warmed.wait()
+        await ingestion.put(event.message, entities.account(event.chat_id))
+
+    analysis = {'client_genai': client_genai, 'region': REGION, 'languages': LANGUAGES, 'bbox': BBOX}
+    tasks = [asyncio.create_task(worker(queue, deferred, store, analysis, stats, batch_size, BACKLOG)) for _ in range(workers)]
+    tasks.append(asyncio.create_task(flush_store(store, ingestion)))
+    tasks.append(asyncio.create_task(catch_up(queue, deferred, ingestion.counter)))
+    tasks.append(asyncio.create_task(log_stats(queue, deferred, stats, ingestion)))
+
+    # The watermarks wait for the backfill, which only starts once the new messages are received
+    if not no_backfill:
+        for account, last_id in last_ids.items():
+            ingestion.hold(account, last_id)
 
     await client.start()
+    await entities.warm(client, CHANNELS)
+    warmed.set()
     logger.info(f'Listening for new messages in {", ".join(CHANNELS)} ...')
 
+    # Catch up the messages posted while the live was down; new messages received meanwhile are not put twice
+    if not no_backfill:
+        tasks.append(asyncio.create_task(backfill(client, ingestion, CHANNELS, last_ids, entities)))
+
     # Keep the script running
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        for task in tasks:
+            task.cancel()
+        store.flush(ingestion.written)
+        store.close()
+
+
+async def worker(queue, deferred, store, analysis, stats, batch_size, backlog):
+    """
+    Take the messages from the queue by priority and analyze them with Gemini.
+    When the queue is deep, up to `batch_size` messages are analyzed in a single request.
+    Under backlog (at least `backlog` messages waiting), the live is degraded so that the lag of the
+    high-priority channels stays bounded: flash-lite only (no escalation), and translation only for the
+    low-priority channels, which are deferred to a catch-up pass.
+    """
+    while True:
+        items = [await queue.get()]
+        under_backlog = queue.qsize() >= backlog
+        if queue.qsize() >= batch_size:
+            while (len(items) < batch_size) and not queue.empty():
+                items.append(queue.get_nowait())
+
+        appended = set()  # object ids of the items written into the store
+        try:
+            if not under_backlog:
+                groups = [(items, COMBINED_PROMPT, CASCADE_MODELS)]
+            else:
+                # Deferred messages waiting for their catch-up are deferred again
+                deferred.extend(item for item in items if item[0] == CATCH_UP)
+                groups = [([item for item in items if item[0] < LOW], COMBINED_PROMPT, CASCADE_MODELS[:1]),
+                          ([item for item in items if item[0] == LOW], TRANSLATION_PROMPT, CASCADE_MODELS[:1])]
+
+            for group, prompt, models in groups:
+                if not group:
+                    continue
+                results = await analyze([dict_infos['text'] for _, _, dict_infos, _ in group], prompt=prompt, models=models, **analysis)
+                stats.n_batches += len(group) > 1
+
+                for item, result in zip(group, results):
+                    priority, _, dict_infos, date_utc = item
+                    if prompt == TRANSLATION_PROMPT:
+                        result = result | {'deferred': True}
+                        deferred.append((CATCH_UP, 0, dict_infos, date_utc))
+                        stats.n_deferred += 1
+                    store.append(dict_infos | result)
+                    appended.add(id(item))
 
+                    if priority == CATCH_UP:
+                        stats.n_caught_up += 1
+                    else:
+                        stats.record(date_utc, priority)
+                        logger.info(f"[{dict_infos['account']}]: {result['text_english']}")
 
-async def new_message_handler(event, datamap, client_genai, prompt, region, languages, timezone):
+        except Exception as e:
+            logger.exception(f"Analysis of {len(items)} messages failed: {e}")
+            # The messages are written anyway, so that the watermark of their account moves past them
+            # (deferred messages are already in the store with their translation)
+            for item in items:
+                if (id(item) not in appended) and (item[0] != CATCH_UP):
+                    store.append(item[2] | FAILED_ANALYSIS)
 
-    text = event.message.message
-    account = getattr(event.chat, 'username', None) or str(event.chat_id)
+        finally:
+            for _ in items:
+                queue.task_done()
 
-    date_utc = event.message.date
-    date_utc = date_utc.replace(tzinfo=ZoneInfo("UTC"))
-    date_local = date_utc.astimezone(ZoneInfo(timezone))
-    date_local = date_local.strftime("%Y-%m-%d %H:%M:%S")
 
-    dict_infos = {'account': account, 'id': event.message.id, 'date': date_local , 'text': text, 'has_photo': False, 'has_video': False}
-    # TODO : photo and video
-    # TODO: get the account not the OP
+async def flush_store(store, ingestion, period: float = 0.5):
+    """
+    Write the analyzed messages into the store periodically, in a single transaction (group commit)
+    with the watermarks of their accounts
+    """
+    while True:
+        await asyncio.sleep(period)
+        store.flush(ingestion.written)
 
-    # Analysis
-    if text:
-        output = structured_analysis(client_genai, text, prompt, region, languages, model_google='gemini-2.0-flash-lite')
-        if output:
-            logger.info(f"[{account}]: {output['translation']}")
 
-            results = {
-            'text_english': output['translation'],
-                'geolocs': [g['location_name'] for g in output['geolocations']], 
-                'coordinates': [(g['latitude'], g['longitude']) for g in output['geolocations']], 
-                'negative': output['sentiment']['negative'], 
-                'neutral': output['sentiment']['neutral'], 
-                'positive': output['sentiment']['positive']}
+async def catch_up(queue, deferred, counter, period: float = 10, size: int = 32):
+    """
+    Put the deferred messages back in the queue, with the lowest priority, when the queue is empty.
+    Their complete analysis replaces the translation-only record in the store, without the flag 'deferred'.
+    """
+    while True:
+        await asyncio.sleep(period)
+        if queue.empty() and deferred:
+            for _ in range(min(size, len(deferred))):
+                _, _, dict_infos, date_utc = deferred.popleft()
+                await queue.put((CATCH_UP, next(counter), dict_infos, date_utc))
 
+
+async def analyze(texts, client_genai, prompt, region, languages, bbox=None, models=CASCADE_MODELS) -> list[dict]:
+    """
+    Return the enhanced fields of each text, with a single request for several texts
+    """
+    posts = {k: text for k, text in enumerate(texts) if text}
+    batch_outputs = None
+
+    # A batch is first analyzed with flash-lite in a single request
+    if (len(posts) > 1) and (prompt == COMBINED_PROMPT):
+        try:
+            batch_outputs = await async_structured_analysis_batch(client_genai, posts, region, languages, model_google=models[0])
+        except genai.errors.APIError as e:
+            logger.error(f"Google API error on a batch of {len(posts)} messages, analyze them one by one: {e}")
+
+    # flash-lite first, escalated to flash only if its output looks unreliable
+    async def cascade(k):
+        try:
+            return await async_cascade_analysis(client_genai, posts[k], prompt, region, languages, models=models, bbox=bbox,
+                                                output=None if batch_outputs is None else batch_outputs.get(k) or {})
+        except genai.errors.APIError as e:
+            logger.error(f"Google API error: {e}")
+
+    outputs = dict(zip(posts, await asyncio.gather(*(cascade(k) for k in posts))))
+
+    results = []
+    for k, text in enumerate(texts):
+        if not text:
+            results.append(EMPTY_ANALYSIS)
+        elif outputs.get(k):
+            results.append(format_output(outputs[k]))
         else:
             logger.warning("Analysis returned None")
-            results = {'text_english': '', 'geolocs': [], 'coordinates': [], 'negative': 0.33, 'neutral': 0.34, 'positive': 0.33}    
+            results.append(FAILED_ANALYSIS)
+    return results
+
 
-    else:
-        results = {'text_english': '', 'geolocs': [], 'coordinates': [], 'negative': 0.0, 'neutral': 1.0, 'positive': 0.0}
+async def log_stats(queue, deferred, stats, ingestion, period: float = 60):
+    """
+    Log the queue depth and the end-to-end lag periodically
+    """
+    while True:
+        await asyncio.sleep(period)
+        logger.info(f"Live: {stats.summary(queue, deferred)}, {ingestion.n_merged} parts of albums merged")
+        logger.info(f"Cascade: {cascade_stats.summary()}")
 
-    with open(os.path.join('./data/datamaps/', datamap, 'telegram_gemini.jsonl'), 'a', encoding='utf-8') as file:  # mode append
-        json.dump(dict_infos | results, file, ensure_ascii=False)
-        file.write('\n')
-    
 
 if __name__ == '__main__':
 
     # Get the current event loop and run the main function
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
\ No newline at end of file
+    loop.run_until_complete(main())
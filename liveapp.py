@@ -1,10 +1,9 @@
 import os
-import json
 import yaml
 import click
 from loguru import logger
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timedelta
 from time import perf_counter
 
 import dash
@@ -15,15 +14,47 @@ from dash import dcc, html, Input, Output, State, Patch
 
 from src.gemini.rag import RAG
 from src.gemini.similarity_search import SimilaritySearch
+from src.gemini.rate_control import install_rate_controller
 
-from src.app.grid import render_message_html
+from src.app.grid import CARD_COLUMN, card_fields
 from src.app.map import get_telegram_locations
-from src.app.chart import generate_chart
+from src.app.chart import generate_chart, extend_chart
+from src.data_telegram.store import LiveStore
 
 # --- List of datamaps ---
 
 list_datamaps = [f for f in os.listdir('./data/datamaps') if os.path.isdir(os.path.join('./data/datamaps', f))]
 
+# --- Stores of the live messages, written by live.py ---
+
+stores = {}
+
+def get_store(datamap: str) -> LiveStore:
+    if datamap not in stores:
+        stores[datamap] = LiveStore.of_datamap(os.path.join('./data/datamaps', datamap))
+    return stores[datamap]
+
+def get_retention(datamap: str) -> dict:
+    """
+    Retention window of the dashboard: only the messages of the last `hours` hours, and at most `max_rows` messages,
+    are kept in memory; older messages stay in the store and are loaded on demand
+    """
+    with open(os.path.join('./data/datamaps', datamap, 'datamap-config.yaml')) as f:
+        live_config = yaml.safe_load(f).get('live', {})
+    return {'hours': live_config.get('retention_hours', 24), 'max_rows': live_config.get('max_rows', 5000)}
+
+def retention_start(store: LiveStore, retention: dict) -> Optional[str]:
+    """
+    Return the date of the oldest message of the retention window (None to keep all the messages)
+    """
+    starts = []
+    last_date = store.date_at_rank(1)
+    if last_date and retention['hours']:
+        starts.append((datetime.strptime(last_date, '%Y-%m-%d %H:%M:%S') - timedelta(hours=retention['hours'])).strftime('%Y-%m-%d %H:%M:%S'))
+    if retention['max_rows'] and (date := store.date_at_rank(retention['max_rows'])):
+        starts.append(date)
+    return max(starts) if starts else None
+
 # --- Connect to Chroma Databases ---
 
 with open('./config.yaml') as f:
@@ -33,6 +64,9 @@ with open('./config.yaml') as f:
 rag = RAG(GOOGLE_API_KEY=GOOGLE_API_KEY)
 similarity_search = SimilaritySearch(GOOGLE_API_KEY=GOOGLE_API_KEY)
 
+# Retry on 429/503 with the rate controller of src/gemini
+install_rate_controller()
+
 # --- Initialize Dash app ---
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.DARKLY])
@@ -107,8 +141,15 @@ app.layout = dbc.Container([
     html.P(id='messages-stat', style={'fontSize': '12px', 'marginLeft': '8px','fontFamily': 'monospace'}),
     dcc.Store(id='all_messages'),
     dcc.Store(id='all_telegram_locations'),
-    dcc.Store(id='messages'),  # TODO: check if faster if store the whole dataset
+    dcc.Store(id='messages'),  # messages shown by the grid, by row id (account/id), including the ones pushed by the refresh
+    dcc.Store(id='messages-loaded', data=0),  # incremented when the messages are loaded again, to rebuild the grid and the chart
+    dcc.Store(id='messages-count', data=0),  # number of messages shown by the grid
     dcc.Store(id='messages-dag-init'),
+    dcc.Store(id='last-rowid', data=0),  # last message of the store already shown
+    dcc.Store(id='window-start'),  # date of the oldest message of the retention window
+    dcc.Store(id='oldest-date'),  # date of the oldest message in the grid, including the older messages loaded on demand
+    dcc.Store(id='evict', data=0),  # incremented to reload the retention window
+    dcc.Interval(id='refresh-interval', interval=5_000),
     dcc.Store(id='is_filtered', data=False),
     html.Hr(style={'marginTop': '8px','marginBottom': '16px'}),
 
@@ -127,6 +168,7 @@ app.layout = dbc.Container([
                         html.Div([dag.AgGrid(id='messages-dag')], id='messages-feed', style={'height': '80vh', 'marginx': '8px'}), 
                         style={'height': '80vh', 'marginx': '8px'}
                     ),
+                    html.Button('Older messages \u2193', id='older-button', style={'width': '100%', 'backgroundColor': 'grey', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px'}),
                     html.Button('Reset filters \u27f3', id='reset-button', style={'width': '100%', 'backgroundColor': 'grey', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px'})
                 ]),
 
@@ -218,42 +260,47 @@ def reset_date(map_name):
 
 @app.callback(
     Output('all_messages', 'data'),
+    Output('last-rowid', 'data'),
+    Output('window-start', 'data'),
+    Output('oldest-date', 'data'),
     Input('datamap', 'value'),
+    Input('date-input', 'value'),
+    Input('evict', 'data'),
     prevent_initial_call=False
 )
-def load_all_messages(datamap: Optional[str]):
+def load_all_messages(datamap: Optional[str], date_start: Optional[str], evict: int):
 
     if datamap:
         tic = perf_counter()
+        store, retention = get_store(datamap), get_retention(datamap)
 
-        all_messages = []
-        with open(os.path.join('./data/datamaps', datamap, 'telegram_gemini.jsonl'), 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    record = json.loads(line)
-                    all_messages.append(record)
-                except json.JSONDecodeError:
-                    continue
+        # Only the messages of the retention window are loaded (messages are unique by (account, id) in the store).
+        # The last rowid is read first, so that the next refreshes only read the messages written since.
+        last_rowid = store.last_rowid()
+        window_start = max(filter(None, [date_start, retention_start(store, retention)]), default=None)
+        all_messages = store.read_window(date_start=window_start, limit=retention['max_rows'])
+        oldest_date = all_messages[0]['date'] if all_messages else window_start
 
-        print(len(all_messages))
+        logger.debug(f"Loaded {len(all_messages)} messages of {datamap} since {window_start}, elapsed time for load_all_messages: {perf_counter() - tic:0.3f} sec")
 
-        # Add additional columns for rendering
-        for idx, message in enumerate(all_messages):
-            all_messages[idx]['message_html'] = render_message_html(message)
-        logger.debug(f"Elapsed time for load_all_messages: {perf_counter() - tic:0.3f} sec")
+        return all_messages, last_rowid, window_start, oldest_date
+    return dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
-        return all_messages
-    return dash.no_update
+def messages_stat(datamap: str, date_start: str, n_messages: int) -> str:
+    return f'Number of Telegram messages in map {datamap} after {date_start}: {n_messages}'
 
 @app.callback(
     Output('messages-stat', 'children'),
     Output('messages', 'data'),
+    Output('messages-loaded', 'data'),
+    Output('messages-count', 'data'),
     Input('datamap', 'value'),
     Input('date-input', 'value'),
     Input('all_messages', 'data'),
+    State('messages-loaded', 'data'),
     prevent_initial_call=False
 )
-def load_messages(datamap: Optional[str], date_start: Optional[str], all_messages):
+def load_messages(datamap: Optional[str], date_start: Optional[str], all_messages, messages_loaded):
 
 
     if datamap and date_start:
@@ -263,39 +310,39 @@ def load_messages(datamap: Optional[str], date_start: Optional[str], all_message
         date_start = datetime.strptime(date_start, '%Y-%m-%d %H:%M')
 
         date_start = date_start.strftime('%Y-%m-%d %H:%M')
-        messages = [m for m in all_messages if date_start <= m['date']]
-        messages_stat = f'Number of Telegram messages in map {datamap} after {date_start}: {len(messages)}'
+        messages = {f"{m['account']}/{m['id']}": m for m in all_messages if date_start <= m['date']}
 
         logger.debug(f"Elapsed time for load_messages: {perf_counter() - tic:0.3f} sec")
 
-        return messages_stat, messages
+        return messages_stat(datamap, date_start, len(messages)), messages, messages_loaded + 1, len(messages)
     
     else:
 
-        return dash.no_update, dash.no_update
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
 @app.callback(
     Output('messages-feed', 'children', allow_duplicate=True), 
     Output('messages-dag-init', 'data'),
-    Input('messages', 'data'), 
+    Input('messages-loaded', 'data'),
+    State('messages', 'data'),
     prevent_initial_call=True
 )
-def create_grid(messages):
+def create_grid(messages_loaded, messages):
     
     tic = perf_counter()
 
     columnDefs = [
-    {'field': 'message_html', 'cellRenderer': 'RenderHTML'},
+    CARD_COLUMN,
     {'field': 'account', 'hide': True},  # Invisible column
     {'field': 'sim', 'hide': True},  # Invisible column
-    {'field': 'date', 'hide': True},  # Invisible column
-    {'field': 'text_english', 'hide': True}  # Invisible column
+    {'field': 'date', 'hide': True}  # Invisible column
     ]
 
     grid = dag.AgGrid(
         id='messages-dag',
         columnDefs=columnDefs,
-        rowData=messages[::-1],
+        rowData=[card_fields(message) for message in list(messages.values())[::-1]],
+        getRowId="params.data.account + '/' + params.data.id",
         columnSize='responsiveSizeToFit',
         dashGridOptions={
             'headerHeight':0, 
@@ -326,10 +373,9 @@ def create_grid(messages):
     Input('messages-dag', 'cellRendererData'),
     Input('is_filtered', 'data'),
     State('messages-dag', 'rowData'),
-    State('all_messages', 'data'),
     prevent_initial_call=True
 )
-def update_grid(cellRendererData, is_filtered, current_row_data, all_messages):
+def update_grid(cellRendererData, is_filtered, current_row_data):
     # FIXME: should use all_row_data
 
     style_common = {'width': '100%', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px'}
@@ -346,11 +392,12 @@ def update_grid(cellRendererData, is_filtered, current_row_data, all_messages):
         # Click to find similar messages
         elif ('showSimilar' in cellRendererData['value']) and (not is_filtered):
 
-            # Format the message 
-            idx = cellRendererData['rowIndex']
-            message, date = all_messages[idx]['text_english'],  all_messages[idx]['date']
+            # Format the message, found by its row id (account/id): rows are prepended by the refresh
+            row_id = cellRendererData['rowId']
+            row = next(row for row in current_row_data if f"{row['account']}/{row['id']}" == row_id)
+            message, date = row['text_english'], row['date']
             query_message = f"[Date: {date}] {message}"
-            logger.info(f"Search for similar message for idx {idx}, {date}")
+            logger.info(f"Search for similar message for {row_id}, {date}")
 
             # Search for the top k
             results = similarity_search.query(query_message, n_results=100)
@@ -384,9 +431,12 @@ def update_filter(filter_value):
     Output('reset-button', 'style', allow_duplicate=True),
     Input('reset-button', 'n_clicks'),
     State('messages-dag-init', 'data'),
+    State('messages', 'data'),
     prevent_initial_call=True
 )
-def reset_grid(n_clicks, initial_grid):
+def reset_grid(n_clicks, initial_grid, messages):
+    # The rows are those of the messages, with the ones pushed by the refresh since the grid was created
+    initial_grid['props']['rowData'] = [card_fields(message) for message in list(messages.values())[::-1]]
     return initial_grid, False, {'width': '100%', 'border': 'none', 'borderRadius': '4px', 'margin-top': '8px', 'backgroundColor': 'grey'}
 
 # --- Callbacks for the RAG system --
@@ -451,6 +501,13 @@ def load_telegram_locations(all_messages):
         return get_telegram_locations(all_messages)
     return []
 
+def telegram_marker(item):
+    return dl.Marker(
+        position=item["position"],
+        children=[dl.Tooltip(item['tooltip']), dl.Popup(item['popup'])],
+        icon = dict(iconUrl='assets/marker-icon-blue.png', iconAnchor=(12, 18))
+    )
+
 @app.callback(
     Output('telegram-layer', 'children'),
     Input('date-input', 'value'),
@@ -461,14 +518,7 @@ def update_telegram_markers(date_start, all_telegram_locations):
 
     if date_start:
 
-        filtered_telegram_locs = [
-            dl.Marker(
-                position=item["position"],
-                children=[dl.Tooltip(item['tooltip']), dl.Popup(item['popup'])],
-                icon = dict(iconUrl='assets/marker-icon-blue.png', iconAnchor=(12, 18))
-            )
-            for item in all_telegram_locations if date_start <= item["date"]
-        ]
+        filtered_telegram_locs = [telegram_marker(item) for item in all_telegram_locations if date_start <= item["date"]]
 
         return filtered_telegram_locs
     
@@ -478,17 +528,108 @@ def update_telegram_markers(date_start, all_telegram_locations):
 
 @app.callback(
     Output('sentiment-chart', 'figure'),
-    Input('messages', 'data'),
+    Input('messages-loaded', 'data'),
     Input('interval', 'value'),
+    State('messages', 'data'),
     prevent_initial_call=True
 )
-def update_sentiment_chart(messages, interval):
+def update_sentiment_chart(messages_loaded, interval, messages):
     tic = perf_counter()
-    chart = generate_chart(messages, interval)
+    chart = generate_chart(list(messages.values()), interval)
     logger.debug(f"Elapsed time for chart: {perf_counter() - tic:0.3f} sec")
     return chart
 
-    # TODO: Patch()
+# --- Callback for the incremental refresh ---
+
+@app.callback(
+    Output('messages-dag', 'rowTransaction'),
+    Output('telegram-layer', 'children', allow_duplicate=True),
+    Output('sentiment-chart', 'extendData'),
+    Output('last-rowid', 'data', allow_duplicate=True),
+    Output('evict', 'data'),
+    Output('messages', 'data', allow_duplicate=True),
+    Output('messages-stat', 'children', allow_duplicate=True),
+    Output('messages-count', 'data', allow_duplicate=True),
+    Input('refresh-interval', 'n_intervals'),
+    State('datamap', 'value'),
+    State('date-input', 'value'),
+    State('interval', 'value'),
+    State('last-rowid', 'data'),
+    State('window-start', 'data'),
+    State('evict', 'data'),
+    State('is_filtered', 'data'),
+    State('messages-count', 'data'),
+    prevent_initial_call=True
+)
+def refresh_messages(n_intervals, datamap, date_start, interval, last_rowid, window_start, evict, is_filtered, messages_count):
+    """
+    Push the messages written by live.py since the last refresh into the grid, the map and the chart,
+    without rebuilding them. When enough messages left the retention window, the window is reloaded instead.
+    While the grid is filtered on an account or shows similar messages, nothing is pushed: the new messages
+    wait in the store and are pushed at the first refresh after the reset.
+    """
+    no_update = [dash.no_update] * 8
+    if not (datamap and date_start) or is_filtered:
+        return no_update
+
+    # Evict the messages older than the retention window by batches of 10% of the window
+    store, retention = get_store(datamap), get_retention(datamap)
+    new_start = retention_start(store, retention)
+    if new_start and (store.count(window_start, new_start) >= max(retention['max_rows'] // 10, 1)):
+        logger.info(f"Evict the messages older than {new_start} from the dashboard")
+        return no_update[:4] + [evict + 1] + no_update[5:]
+
+    new_messages, new_rowid, replaced = store.read_since(last_rowid)
+    new_messages = [m for m in new_messages if date_start <= m['date']]
+    if not new_messages:
+        return no_update[:3] + [new_rowid] + no_update[4:]
+
+    tic = perf_counter()
+    new_messages.sort(key=lambda m: m['date'], reverse=True)  # newest first
+
+    # A message written again (e.g. catch-up of a deferred message) replaces its row, in place;
+    # it is already counted in the markers and the chart, which are only extended with the new messages
+    replacements = [m for m in new_messages if (m['account'], m['id']) in replaced]
+    new_messages = [m for m in new_messages if (m['account'], m['id']) not in replaced]
+    transaction = {'update': [card_fields(m) for m in replacements], 'add': [card_fields(m) for m in new_messages], 'addIndex': 0}
+
+    messages = Patch()
+    for message in replacements + new_messages[::-1]:
+        messages[f"{message['account']}/{message['id']}"] = message
+
+    markers, chart = dash.no_update, dash.no_update
+    if new_messages:
+        markers = Patch()
+        for item in get_telegram_locations(new_messages):
+            markers.append(telegram_marker(item))
+        chart = extend_chart(new_messages, interval)
+
+    logger.debug(f"Elapsed time for refresh_messages ({len(new_messages)} new messages, {len(replacements)} replaced): {perf_counter() - tic:0.3f} sec")
+
+    messages_count += len(new_messages)
+    return (transaction, markers, chart, new_rowid, dash.no_update, messages,
+            messages_stat(datamap, date_start, messages_count), messages_count)
+
+@app.callback(
+    Output('messages-dag', 'rowTransaction', allow_duplicate=True),
+    Output('oldest-date', 'data', allow_duplicate=True),
+    Input('older-button', 'n_clicks'),
+    State('datamap', 'value'),
+    State('oldest-date', 'data'),
+    prevent_initial_call=True
+)
+def load_older_messages(n_clicks, datamap, oldest_date, page_size: int = 200):
+    """
+    Append the messages older than the grid at its bottom, from the store; they are dropped at the next reload of the window
+    """
+    if not (datamap and oldest_date):
+        return dash.no_update, dash.no_update
+
+    older_messages = get_store(datamap).read_window(date_end=oldest_date, limit=page_size)
+    if not older_messages:
+        return dash.no_update, dash.no_update
+
+    return {'add': [card_fields(message) for message in older_messages[::-1]]}, older_messages[0]['date']
 
 # --- Main function ---
 
@@ -1,6 +1,8 @@
 import pandas as pd
 import plotly.express as px
 
+SENTIMENTS = ['negative', 'neutral', 'positive']
+
 
 def generate_chart(messages, interval):
 
@@ -11,11 +13,13 @@ def generate_chart(messages, interval):
     # Get the dominant sentiment for each message
     df['dominant_sentiment'] = df[['negative', 'neutral', 'positive']].idxmax(axis=1)
 
-    grouped = df.groupby(['date_r', 'dominant_sentiment']).size().unstack(fill_value=0).reset_index()
+    # All sentiments are kept in a fixed order, so that the traces are always negative (0), neutral (1) and positive (2)
+    grouped = df.groupby(['date_r', 'dominant_sentiment']).size().unstack(fill_value=0).reindex(columns=SENTIMENTS, fill_value=0).reset_index()
     df_sentiment = pd.melt(grouped, id_vars=['date_r'], var_name='sentiment', value_name='count')
 
     fig = px.bar(df_sentiment, x='date_r', y='count', color='sentiment',
                  color_discrete_map={'neutral': '#eeeeee', 'negative': '#e74c3c', 'positive': '#2ecc71'},
+                 category_orders={'sentiment': SENTIMENTS},
                  labels={'date_r': '', 'count': 'Number of messages'})
 
     # Update the layout for dark background
@@ -38,4 +42,22 @@ def generate_chart(messages, interval):
         )
     )
 
-    return fig
\ No newline at end of file
+    return fig
+
+
+def extend_chart(messages, interval):
+    """
+    Return the extendData of the chart generated by generate_chart for new messages:
+    one bar per (date, dominant sentiment), stacked over the existing bars of the same date
+    """
+    df = pd.DataFrame(messages)
+    df['date_r'] = pd.to_datetime(df['date']).dt.round(interval)
+    df['dominant_sentiment'] = df[SENTIMENTS].idxmax(axis=1)
+
+    x, y = [], []
+    for sentiment in SENTIMENTS:
+        counts = df[df['dominant_sentiment'] == sentiment].groupby('date_r').size()
+        x.append(counts.index.strftime('%Y-%m-%d %H:%M:%S').tolist())
+        y.append(counts.tolist())
+
+    return dict(x=x, y=y), list(range(len(SENTIMENTS)))
\ No newline at end of file
@@ -0,0 +1,74 @@
+import os
+import json
+import numpy as np
+from loguru import logger
+
+from ..data_telegram.build_columnar import build_columnar, columnar_directory, COLUMNAR_VERSION, STRING_COLUMNS, SENTIMENTS
+
+
+class ColumnarDatamap:
+    """
+    Messages of a datamap in the columnar layout written by build_columnar.py.
+    Columns are memory-mapped: only the pages of the rows actually read are loaded from the disk.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as file:
+            self.meta = json.load(file)
+        self.columns = {name[:-len('.npy')]: np.load(os.path.join(directory, name), mmap_mode='r')
+                        for name in os.listdir(directory) if name.endswith('.npy')}
+
+    def __len__(self):
+        return self.meta['n_messages']
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def string(self, name: str, i: int) -> str:
+        offsets = self.columns[f'{name}.offsets']
+        return self.columns[f'{name}.bytes'][offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+    def record(self, i: int) -> dict:
+        """
+        Return the message of row i, with the fields of telegram_<method>.json
+        """
+        i = int(i)
+        record = {name: self.string(name, i) for name in STRING_COLUMNS}
+        record['id'] = int(self.columns['id'][i])
+        record['has_photo'] = bool(self.columns['has_photo'][i])
+        record['has_video'] = bool(self.columns['has_video'][i])
+        for sentiment in SENTIMENTS:
+            record[sentiment] = float(self.columns[sentiment][i])
+
+        locations = range(self.columns['loc_offsets'][i], self.columns['loc_offsets'][i + 1])
+        record['geolocs'] = [self.string('loc_name', k) for k in locations]
+        record['coordinates'] = [(float(self.columns['loc_lat'][k]), float(self.columns['loc_lon'][k])) for k in locations]
+        return record
+
+    def records(self, rows) -> list[dict]:
+        """
+        Return the messages of a slice (or of a list of rows)
+        """
+        if isinstance(rows, slice):
+            rows = range(*rows.indices(len(self)))
+        return [self.record(i) for i in rows]
+
+
+def load_columnar(datamap_dir: str, method: str = 'gemini') -> ColumnarDatamap:
+    """
+    Return the columnar messages of a datamap, built from telegram_<method>.json first if they are missing or outdated
+    """
+    directory = columnar_directory(datamap_dir, method)
+    source = os.path.join(datamap_dir, f'telegram_{method}.json')
+
+    meta = None
+    if directory and os.path.exists(os.path.join(directory, 'meta.json')):
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as file:
+            meta = json.load(file)
+
+    if (meta is None) or (meta['version'] != COLUMNAR_VERSION) or (os.path.exists(source) and meta['source_mtime'] != os.path.getmtime(source)):
+        logger.info(f"Build the columnar messages of {datamap_dir} from {os.path.basename(source)}")
+        directory = build_columnar(datamap_dir, method)
+
+    return ColumnarDatamap(directory)
@@ -10,47 +10,52 @@ from time import perf_counter
 from dash import html
 
 
-def get_telegram_locations(all_messages: list[dict]) -> list[dict]:
+def telegram_location(account: str, message_id: int, date: str, text: str, lat: float, lon: float) -> dict:
     """
-    Return a list of all locations mentionned in Telegram posts
+    Return the marker information of a location mentioned in a Telegram post
     """
+    url = f"https://t.me/{account}/{message_id}"
 
-    # Format the tooltip for a message
-    def get_locations(message):
-
-        account, date = message['account'], message['date']
-        text = message['text_english']
-        url = f"https://t.me/{account}/{message['id']}"
-        # has_photo, has_video = message['has_photo'], message['has_video']
+    tooltip = html.Div([
+        html.Div([
+            html.Span(account, style={'float': 'left', 'paddingLeft': '3px'}),
+            html.Span(date, style={'float': 'right', 'paddingRight': '3px'})
+            ], style={'display': 'flex', 'justifyContent': 'space-between', 'alignItems': 'center'}),
+        html.Div(text, style={'marginTop': '2px', 'padding': '3px'}),
+        # html.Img(src='./assets/photo.png', height=16) if has_photo else None,
+        # html.Img(src='./assets/video.png', height=16) if has_video else None,
+        ], style={'whiteSpace': 'normal', 'width': '300px', 'borderRadius': '8px'})  
 
-        locations = []
-        for geoloc, coords in zip(message['geolocs'], message['coordinates']):
-            lat, lon = coords
+    popup = html.A(url, href=url, target='_blank')
 
-            tooltip = html.Div([
-                html.Div([
-                    html.Span(account, style={'float': 'left', 'paddingLeft': '3px'}),
-                    html.Span(date, style={'float': 'right', 'paddingRight': '3px'})
-                    ], style={'display': 'flex', 'justifyContent': 'space-between', 'alignItems': 'center'}),
-                html.Div(text, style={'marginTop': '2px', 'padding': '3px'}),
-                # html.Img(src='./assets/photo.png', height=16) if has_photo else None,
-                # html.Img(src='./assets/video.png', height=16) if has_video else None,
-                ], style={'whiteSpace': 'normal', 'width': '300px', 'borderRadius': '8px'})  
+    return {'position': (lat, lon), 'tooltip': tooltip, 'popup': popup, 'date': date}
 
-            popup = html.A(url, href=url, target='_blank')
 
-            locations.append({'position': (lat, lon), 'tooltip': tooltip, 'popup': popup, 'date': date})
-
-        return locations
+def get_telegram_locations(all_messages: list[dict]) -> list[dict]:
+    """
+    Return a list of all locations mentionned in Telegram posts
+    """
 
     # List of all locations mentioned in Telegram posts
     telegram_locations = []
     for message in all_messages:
-        telegram_locations.extend(get_locations(message))
+        for lat, lon in message['coordinates']:
+            telegram_locations.append(telegram_location(message['account'], message['id'], message['date'], message['text_english'], lat, lon))
 
     return telegram_locations
 
 
+def geoconfirmed_files(datamap: str) -> list[str]:
+    """
+    Return the paths of the latest version of each Geoconfirmed map of a datamap
+    """
+    with open(os.path.join('data/datamaps', datamap, 'datamap-config.yaml')) as f:
+        config = yaml.safe_load(f)
+        list_maps = config['geoconfirmed']
+
+    return [os.path.join('data/geoconfirmed', mapname, sorted(os.listdir(os.path.join('data/geoconfirmed', mapname)))[-1]) for mapname in list_maps]
+
+
 def get_geoconfirmed_locations(datamap:str) -> list[dict]:
 
     def get_description(full_description: str) -> str:
@@ -74,21 +79,13 @@ def get_geoconfirmed_locations(datamap:str) -> list[dict]:
             
         return urls
 
-    # Open datamap to get the list of Geoconfirmed maps to load
-    with open(os.path.join('data/datamaps', datamap, 'datamap-config.yaml')) as f:
-        config = yaml.safe_load(f)
-        list_maps = config['geoconfirmed']
-
     geoconfirmed_locations = []
-    for mapname in list_maps:
+    for path in geoconfirmed_files(datamap):
 
-        # Find the latest version of Geoconfirmed
-        filename = sorted(os.listdir(os.path.join('data/geoconfirmed', mapname)))[-1]
-        
         tic = perf_counter()
 
         # Open KMZ map and parse it
-        with ZipFile(os.path.join('data/geoconfirmed', mapname, filename)) as kmz:
+        with ZipFile(path) as kmz:
             with kmz.open('doc.kml') as kml_file:
                 kml = kml_file.read()
         soup = BeautifulSoup(kml, 'lxml-xml')  # faster than 'xml'
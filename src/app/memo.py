@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Callable
+from loguru import logger
+
+
+def deep_sizeof(value) -> int:
+    """
+    Estimate the memory of a Python value and of the dicts, lists, tuples and sets it holds, recursively
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(deep_sizeof(item) for item in value)
+    return size
+
+
+class MemoCache:
+    """
+    Process-wide memo of the loaded datamaps, shared by all the sessions of the dashboard.
+    An entry is keyed by the name of the datamap and the modification times of its source files: it is loaded
+    again when one of them changes. The least recently used entries are evicted above `max_bytes` (as estimated
+    by the `sizeof` given to `get`). Concurrent sessions wait for the first one loading a datamap.
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # name -> (mtimes of the sources, value, estimated size in bytes)
+        self.lock = threading.Lock()
+        self.loading = defaultdict(threading.Lock)  # name -> lock held while loading it
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, name: str, sources: list[str], load: Callable[[], object], sizeof: Callable[[object], int]):
+        """
+        Return the memoized value of `name`, loaded with `load()` if it is missing or if one of its sources changed
+        """
+        # The lock of a name is created under the lock of the memo, so that concurrent misses share it
+        with self.lock:
+            loading = self.loading[name]
+
+        with loading:
+            with self.lock:
+                entry = self.entries.get(name)
+                if entry and entry[0] == self._mtimes(sources):
+                    self.entries.move_to_end(name)
+                    self.hits += 1
+                    logger.debug(f"Memo of {name}: hit ({self.summary()})")
+                    return entry[1]
+
+            if entry:
+                logger.info(f"Memo of {name}: a source changed, load it again")
+            value = load()
+            size = sizeof(value)
+
+            with self.lock:
+                self.misses += 1
+                # The sources are read after the load, which may have written some of them (e.g. a build)
+                self.entries[name] = (self._mtimes(sources), value, size)
+                self.entries.move_to_end(name)
+                while (self.size() > self.max_bytes) and (len(self.entries) > 1):
+                    evicted, _ = self.entries.popitem(last=False)
+                    self.evictions += 1
+                    logger.info(f"Memo: evict {evicted}")
+                logger.info(f"Memo of {name}: loaded ({size / 1024 ** 2:0.1f} MB; {self.summary()})")
+            return value
+
+    @staticmethod
+    def _mtimes(sources: list[str]) -> tuple:
+        return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in sources)
+
+    def size(self) -> int:
+        return sum(size for _, _, size in self.entries.values())
+
+    def summary(self) -> str:
+        total = max(self.hits + self.misses, 1)
+        return (f"{self.hits} hits, {self.misses} misses, hit rate {self.hits / total:0.0%}, {self.evictions} evictions, "
+                f"{len(self.entries)} entries, {self.size() / 1024 ** 2:0.1f}/{self.max_bytes / 1024 ** 2:0.0f} MB")
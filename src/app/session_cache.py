@@ -0,0 +1,34 @@
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+
+class SessionCache:
+    """
+    Server-side data of the sessions of the dashboard, keyed by (session id, datamap), so that only small keys
+    and the bounds of the time window go through the browser.
+    The least recently used entries are evicted above `max_entries`.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str, datamap: str) -> dict:
+        """
+        Return the (mutable) entry of a session and a datamap, created empty if missing or evicted
+        """
+        key = (session_id, datamap)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                self.entries[key] = {}
+                while len(self.entries) > self.max_entries:
+                    evicted, _ = self.entries.popitem(last=False)
+                    logger.debug(f"Evict the session cache of {evicted}")
+            return self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
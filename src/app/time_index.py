@@ -0,0 +1,51 @@
+import numpy as np
+from datetime import datetime, timedelta
+
+from ..data_telegram.build_columnar import to_epoch
+
+DAY = 86_400
+
+
+class TimeWindowIndex:
+    """
+    Sorted epoch seconds of the messages, the Telegram locations and the Geoconfirmed events of a datamap.
+    The rows of a window [start, end) are found by binary search, in O(log n) whatever the size of the datamap.
+    """
+
+    def __init__(self, messages: np.ndarray, telegram_locations: np.ndarray, geoconfirmed: np.ndarray):
+        self.ts = {'messages': messages, 'telegram_locations': telegram_locations, 'geoconfirmed': geoconfirmed}
+
+    @classmethod
+    def of_datamap(cls, columnar, geoconfirmed_locations: list[dict]):
+        """
+        Args:
+            columnar (ColumnarDatamap): messages of the datamap
+            geoconfirmed_locations (list[dict]): Geoconfirmed events sorted by date (a datetime.date)
+        """
+        geoconfirmed = np.array([item['date'] for item in geoconfirmed_locations], dtype='datetime64[D]')
+        return cls(columnar['ts'], columnar['loc_ts'], geoconfirmed.astype('datetime64[s]').astype(np.int64))
+
+    @staticmethod
+    def window(date_start: str, duration: int) -> tuple[int, int]:
+        """
+        Return the epochs [start, end) of a window of `duration` hours starting at date_start (YYYY-MM-DD HH:MM)
+        """
+        start = datetime.strptime(date_start, '%Y-%m-%d %H:%M')
+        end = start + timedelta(hours=duration)
+        return tuple(int(epoch) for epoch in to_epoch([start, end]))
+
+    def _slice(self, name: str, start: int, end: int) -> slice:
+        ts = self.ts[name]
+        return slice(int(np.searchsorted(ts, start, side='left')), int(np.searchsorted(ts, end, side='left')))
+
+    def messages(self, start: int, end: int) -> slice:
+        return self._slice('messages', start, end)
+
+    def telegram_locations(self, start: int, end: int) -> slice:
+        return self._slice('telegram_locations', start, end)
+
+    def geoconfirmed(self, start: int, end: int) -> slice:
+        """
+        Geoconfirmed events are only dated by day: the events of all the days overlapping [start, end) are returned
+        """
+        return self._slice('geoconfirmed', start - start % DAY, end)
@@ -1,6 +1,5 @@
 import os
 import sys
-import json
 import click
 import asyncio
 from tqdm import tqdm
@@ -10,7 +9,7 @@ from geolocation import load_model_geolocation, get_location_name, get_coordinat
 from sentiment_analysis import load_model_sentiment, get_sentiment
 
 sys.path.append('..')
-from data_telegram.extractor import extract_message
+from data_telegram.journal import load_messages
 
 
 @click.command()
@@ -22,23 +21,9 @@ def main(datamap, account):
     model_geoloc = load_model_geolocation()
     tokenizer_sentiment, model_sentiment = load_model_sentiment()
 
-    # Baseline file
-    if not os.path.exists(os.path.join('../../data/datamaps', datamap, account, 'baseline.json')):
-
-        # Open the result.json
-        with open(os.path.join('../../data/datamaps', datamap, account, 'result.json'), encoding='utf-8') as file:
-            result = json.load(file)
-
-        # Extract raw messages
-        messages = [extract_message(m, account) for m in result['messages']]
-
-        with open(os.path.join('../../data/datamaps', datamap, account, 'baseline.json'), 'w', encoding='utf-8') as file:
-            json.dump(messages, file, indent=4, ensure_ascii=False)  
-    else:
-
-        # Open the baseline.json
-        with open(os.path.join('../../data/datamaps', datamap, account, 'baseline.json'), encoding='utf-8') as file:
-            messages = json.load(file)
+    # Load the messages, and the ones already enriched by a previous run
+    account_dir = os.path.join('../../data/datamaps', datamap, account)
+    messages, journal = load_messages(account_dir, account, method='baseline')
 
     # Iterate over messages
     for i, message in tqdm(enumerate(messages), desc=f"Converting messages of {account}", leave=True, total=len(messages)):
@@ -57,14 +42,11 @@ def main(datamap, account):
             else:
                 messages[i] =  message | {'text_english': '', 'geolocs': [], 'coordinates': []} | {'negative': 0.0, 'neutral': 1.0, 'positive': 0.0}
 
-        # Early saving in case of an error
-        if i % 10 == 0:
-            with open(os.path.join('../../data/datamaps', datamap, account, 'baseline.json'), 'w', encoding='utf-8') as file:
-                json.dump(messages, file, indent=4, ensure_ascii=False)
+            # Checkpoint in case of an error
+            journal.append(messages[i])
 
-    # Save the final file
-    with open(os.path.join('../../data/datamaps', datamap, account, 'baseline.json'), 'w', encoding='utf-8') as file:
-        json.dump(messages, file, indent=4, ensure_ascii=False)
+    # Compact the journal into the final file
+    journal.compact(messages, os.path.join(account_dir, 'baseline.json'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import click
+import shutil
+import numpy as np
+from loguru import logger
+
+try:
+    from .search_index import build_search_index
+except ImportError:
+    from search_index import build_search_index
+
+# Version of the layout, written in meta.json: a datamap built with another version is built again
+COLUMNAR_VERSION = 4
+
+SENTIMENTS = ['negative', 'neutral', 'positive']
+STRING_COLUMNS = ['account', 'date', 'text', 'text_english']
+
+
+def to_epoch(dates) -> np.ndarray:
+    """
+    Return the epoch seconds (int64) of local dates in the format YYYY-MM-DD HH:MM[:SS] (or YYYY-MM-DD).
+    The timezone of the datamap is ignored: epochs are only compared between themselves.
+    """
+    return np.array(dates, dtype='datetime64[s]').astype(np.int64)
+
+
+def write_strings(directory: str, name: str, values: list[str]):
+    """
+    Write a column of strings as a single UTF-8 blob (<name>.bytes.npy) and the offsets of each value (<name>.offsets.npy)
+    """
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    np.save(os.path.join(directory, f'{name}.bytes.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(directory, f'{name}.offsets.npy'), offsets)
+
+
+def columnar_directory(datamap_dir: str, method: str = 'gemini') -> str | None:
+    """
+    Return the directory of the current build of columnar_<method> (named by its file CURRENT), or None if there is none
+    """
+    root = os.path.join(datamap_dir, f'columnar_{method}')
+    if not os.path.exists(os.path.join(root, 'CURRENT')):
+        return None
+    with open(os.path.join(root, 'CURRENT'), encoding='utf-8') as file:
+        return os.path.join(root, file.read().strip())
+
+
+def remove_old_builds(root: str, current: str):
+    """
+    Remove the builds older than the current one (and the files of the previous flat layout). The processes that
+    still map them keep reading them on POSIX; elsewhere, the files in use are left for the next build.
+    """
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if (name in ('CURRENT', current)) or name.startswith('.') or (name.startswith('build-') and (name > current)):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def build_columnar(datamap_dir: str, method: str = 'gemini') -> str:
+    """
+    Convert telegram_<method>.json into a columnar build in columnar_<method>, sorted by epoch timestamp:
+        - ts, id, negative, neutral, positive, sentiment (index of the dominant one), has_photo, has_video: one .npy each
+        - account, date, text, text_english: strings as a blob and offsets
+        - loc_offsets: locations of the message i are loc_offsets[i]:loc_offsets[i + 1] of
+          loc_ts, loc_message, loc_lat, loc_lon and loc_name (sorted by timestamp as well)
+        - search.sqlite: full-text index of text_english and text, whose rowid is the row of the message
+    The files of a build are never modified, since the dashboard maps them: a new build is written into a temporary
+    directory, renamed to build-<time>, then made current by replacing the file CURRENT (os.replace is atomic).
+    Return the path of the new build.
+    """
+    source = os.path.join(datamap_dir, f'telegram_{method}.json')
+    root = os.path.join(datamap_dir, f'columnar_{method}')
+    build = f'build-{time.time_ns()}'
+    directory = os.path.join(root, f'.{build}.tmp')
+    os.makedirs(directory)
+
+    with open(source, encoding='utf-8') as file:
+        messages = json.load(file)
+
+    # A stable sort keeps the order of create_datamap.py for messages of the same date
+    ts = to_epoch([m['date'] for m in messages])
+    order = np.argsort(ts, kind='stable')
+    messages = [messages[i] for i in order]
+    ts = ts[order]
+
+    columns = {
+        'ts': ts,
+        'id': np.array([m['id'] for m in messages], dtype=np.int64),
+        'has_photo': np.array([bool(m.get('has_photo')) for m in messages], dtype=bool),
+        'has_video': np.array([bool(m.get('has_video')) for m in messages], dtype=bool),
+    }
+    for sentiment in SENTIMENTS:
+        columns[sentiment] = np.array([m[sentiment] for m in messages], dtype=np.float64)
+    columns['sentiment'] = np.argmax(np.stack([columns[s] for s in SENTIMENTS], axis=1), axis=1).astype(np.int8) if messages else np.zeros(0, dtype=np.int8)
+
+    # Locations, grouped by message
+    n_locations = [len(m['coordinates']) for m in messages]
+    columns['loc_offsets'] = np.zeros(len(messages) + 1, dtype=np.int64)
+    columns['loc_offsets'][1:] = np.cumsum(n_locations)
+    columns['loc_message'] = np.repeat(np.arange(len(messages), dtype=np.int64), n_locations)
+    columns['loc_ts'] = ts[columns['loc_message']]
+    columns['loc_lat'] = np.array([lat for m in messages for lat, _ in m['coordinates']], dtype=np.float64)
+    columns['loc_lon'] = np.array([lon for m in messages for _, lon in m['coordinates']], dtype=np.float64)
+
+    for name, values in columns.items():
+        np.save(os.path.join(directory, f'{name}.npy'), values)
+
+    for name in STRING_COLUMNS:
+        write_strings(directory, name, [m[name] or '' for m in messages])
+    write_strings(directory, 'loc_name', [geoloc for m in messages for geoloc in m['geolocs']])
+    build_search_index(os.path.join(directory, 'search.sqlite'), messages)
+
+    # meta.json is written last: a directory without it is an unfinished build
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as file:
+        json.dump({'version': COLUMNAR_VERSION, 'source': os.path.basename(source), 'source_mtime': os.path.getmtime(source),
+                   'n_messages': len(messages), 'n_locations': int(columns['loc_offsets'][-1])}, file, indent=4)
+
+    os.replace(directory, os.path.join(root, build))
+    with open(os.path.join(root, 'CURRENT.tmp'), 'w', encoding='utf-8') as file:
+        file.write(build)
+    os.replace(os.path.join(root, 'CURRENT.tmp'), os.path.join(root, 'CURRENT'))
+    remove_old_builds(root, build)
+
+    logger.success(f"Built {os.path.join(root, build)} ({len(messages)} messages, {int(columns['loc_offsets'][-1])} locations)")
+    return os.path.join(root, build)
+
+
+@click.command()
+@click.option('--datamap', help='Name of the datamap')
+@click.option('--method', help='Name of the method', type=click.Choice(['baseline', 'gemini']))
+def main(datamap, method):
+    build_columnar(os.path.join('../../data/datamaps', datamap), method)
+
+
+if __name__ == '__main__':
+    main()
+
+# uv run build_columnar.py --datamap syria_241125-241215 --method gemini
@@ -3,6 +3,8 @@ import json
 import click
 from loguru import logger
 
+from build_columnar import build_columnar
+
 
 @click.command()
 @click.option('--datamap', help='Name of the datamap')
@@ -51,6 +53,9 @@ def main(datamap, method):
     with open(os.path.join('../../data/datamaps', datamap, f'telegram_{method}.json'), 'w', encoding='utf-8') as file:
         json.dump(sorted_data, file, indent=4, ensure_ascii=False)  
 
+    # Columnar layout and full-text index loaded by the dashboard
+    build_columnar(os.path.join('../../data/datamaps', datamap), method)
+
 
 if __name__ == '__main__':
     main()
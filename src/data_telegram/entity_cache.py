@@ -0,0 +1,49 @@
+import os
+import json
+from loguru import logger
+from telethon import utils
+
+
+class EntityCache:
+    """
+    Map from the peer id of the channels of a datamap to their name in datamap-config.yaml, persisted in
+    data/datamaps/<datamap>/entities.json. It is warmed at startup, so that the account of a new message
+    is resolved from its chat_id without any request to Telegram.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.accounts = {}  # peer id -> name of the channel
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                self.accounts = {int(peer_id): account for peer_id, account in json.load(file).items()}
+
+    async def warm(self, client, channels: list[str]):
+        """
+        Resolve the channels missing from the cache (a single request per new channel), then persist the cache
+        """
+        known = set(self.accounts.values())
+        missing, n_resolved = [channel for channel in channels if channel not in known], 0
+        for channel in missing:
+            try:
+                entity = await client.get_entity(channel)
+            except Exception as e:
+                logger.error(f"Cannot resolve the channel {channel}: {e}")
+                continue
+            self.accounts[utils.get_peer_id(entity)] = channel
+            n_resolved += 1
+
+        if n_resolved:
+            self.save()
+        logger.info(f"Entity cache: {len(self.accounts)} channels ({n_resolved} resolved at startup)")
+
+    def save(self):
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({str(peer_id): account for peer_id, account in self.accounts.items()}, file, indent=4, ensure_ascii=False)
+        os.replace(self.path + '.tmp', self.path)
+
+    def account(self, peer_id: int) -> str:
+        """
+        Return the name of the channel of a peer id (e.g. event.chat_id), or the peer id itself if unknown
+        """
+        return self.accounts.get(peer_id, str(peer_id))
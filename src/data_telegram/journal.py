@@ -0,0 +1,98 @@
+import os
+import json
+from loguru import logger
+
+from .extractor import extract_message
+
+
+class Journal:
+    """
+    Append-only JSONL journal of enriched messages, used as a checkpoint during the enrichment of an account.
+    Each enriched message is appended as a single line, so saving is O(1) per message instead of
+    re-serializing the whole file. After a crash, the journal resumes from the last complete record.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def load(self) -> dict[int, dict]:
+        """
+        Return the records of the journal by message id.
+        A partially written last line (crash during a write) is removed from the journal.
+        """
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+
+        committed = 0  # offset after the last complete record
+        with open(self.path, 'rb') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                records[record['id']] = record
+                committed += len(line)
+
+        if committed < os.path.getsize(self.path):
+            logger.warning(f"Truncate the incomplete last record of {self.path}")
+            with open(self.path, 'r+b') as file:
+                file.truncate(committed)
+
+        logger.info(f"Resume from {len(records)} records of {self.path}")
+        return records
+
+    def append(self, record: dict):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def compact(self, messages: list[dict], output_path: str):
+        """
+        Write all the messages into the final JSON file, then remove the journal
+        """
+        self.close()
+
+        # Write into a temporary file first, so that the previous file is never left half-written
+        with open(output_path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(messages, file, indent=4, ensure_ascii=False)
+        os.replace(output_path + '.tmp', output_path)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_messages(account_dir: str, account: str, method: str) -> tuple[list[dict], Journal]:
+    """
+    Load the messages of an account, with the ones already enriched by a previous run
+    (either in the final file <method>.json or in its journal <method>.journal.jsonl)
+    Args:
+        account_dir (str): folder of the account in the datamap
+        account (str): name of the account
+        method (str): 'gemini' or 'baseline'
+    """
+    # Final file of a previous run, or raw messages from the Telegram export
+    if os.path.exists(os.path.join(account_dir, f'{method}.json')):
+        with open(os.path.join(account_dir, f'{method}.json'), encoding='utf-8') as file:
+            messages = json.load(file)
+    else:
+        with open(os.path.join(account_dir, 'result.json'), encoding='utf-8') as file:
+            result = json.load(file)
+        messages = [extract_message(m, account) for m in result['messages']]
+
+    # Messages enriched since the last compaction
+    journal = Journal(os.path.join(account_dir, f'{method}.journal.jsonl'))
+    enriched = journal.load()
+    messages = [enriched.get(m['id'], m) for m in messages]
+
+    return messages, journal
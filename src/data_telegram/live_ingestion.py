@@ -0,0 +1,187 @@
+import asyncio
+import itertools
+from loguru import logger
+from collections import defaultdict
+from zoneinfo import ZoneInfo
+from telethon import errors, utils
+
+# Priorities of the channels: 0 (high), 1 (normal) or 2 (low); deferred messages are analyzed after all of them
+HIGH, NORMAL, LOW, CATCH_UP = 0, 1, 2, 3
+
+
+class LiveIngestion:
+    """
+    Entry point of the Telegram messages of the live (new messages and backfill) into the priority queue of the workers.
+    Each message (account, id) is only put once in the queue.
+    The parts of an album (messages sharing a grouped_id) are buffered during `album_window` seconds
+    and merged into a single record, so that the album is analyzed once.
+    The watermark of an account is the id up to which all the messages put were written in the store (see `written`):
+    only the ids above it are remembered, and it never passes the position of a backfill in progress (see `hold`).
+    """
+
+    def __init__(self, queue: asyncio.PriorityQueue, timezone: str, priorities: dict = None, album_window: float = 2.0,
+                 watermarks: dict[str, int] = None):
+        self.queue = queue
+        self.timezone = timezone
+        self.priorities = priorities or {}
+        self.album_window = album_window
+        self.counter = itertools.count()
+        self.watermarks = dict(watermarks or {})  # account -> id up to which all the messages put were written
+        self.seen = defaultdict(set)     # account -> ids put in the queue above its watermark
+        self.pending = defaultdict(set)  # account -> ids put in the queue and not written yet
+        self.parts = {}      # (account, id of an album) -> ids of its parts
+        self.cursors = {}    # account (lowercase) -> id of the last message put by its backfill in progress
+        self.albums = {}     # (account, grouped_id) -> parts of an album waiting for the end of its window
+        self.tasks = set()   # flushes of the albums in progress
+        self.n_merged = 0    # parts of albums merged into another record
+
+    def message_infos(self, messages: list, account: str) -> tuple[dict, object]:
+        """
+        Return the raw fields of a Telethon message (or of the parts of an album), and its date in UTC
+        """
+        messages = sorted(messages, key=lambda m: m.id)
+        date_utc = messages[0].date
+        date_utc = date_utc.replace(tzinfo=ZoneInfo("UTC"))
+        date_local = date_utc.astimezone(ZoneInfo(self.timezone))
+        date_local = date_local.strftime("%Y-%m-%d %H:%M:%S")
+
+        # The caption of an album is usually on a single part
+        text = '\n'.join(m.message for m in messages if m.message)
+        has_photo = any(getattr(m, 'photo', None) for m in messages)
+        has_video = any(getattr(m, 'video', None) for m in messages)
+
+        # The last id of the album is kept, so that the backfill resumes after all its parts
+        dict_infos = {'account': account, 'id': messages[-1].id, 'date': date_local , 'text': text, 'has_photo': has_photo, 'has_video': has_video}
+        return dict_infos, date_utc
+
+    async def put(self, message, account: str, priority: int = None) -> bool:
+        """
+        Put a message in the queue (or in the buffer of its album), unless it was already put; return True if it was put
+        """
+        if (message.id <= self.watermarks.get(account, 0)) or (message.id in self.seen[account]):
+            return False
+        self.seen[account].add(message.id)
+        self.pending[account].add(message.id)
+
+        if getattr(message, 'grouped_id', None):
+            key = (account, message.grouped_id)
+            if key not in self.albums:
+                self.albums[key] = []
+                task = asyncio.create_task(self._flush_album(key, priority))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            self.albums[key].append(message)
+            return True
+
+        await self._put([message], account, priority)
+        return True
+
+    async def _flush_album(self, key: tuple, priority: int = None):
+        await asyncio.sleep(self.album_window)
+        messages = self.albums.pop(key)
+        self.n_merged += len(messages) - 1
+        self.parts[(key[0], max(m.id for m in messages))] = [m.id for m in messages]
+        await self._put(messages, key[0], priority)
+
+    async def _put(self, messages: list, account: str, priority: int = None):
+        dict_infos, date_utc = self.message_infos(messages, account)
+        if priority is None:
+            priority = min(self.priorities.get(account, NORMAL), LOW)
+
+        if self.queue.full():
+            logger.warning(f"Queue full ({self.queue.qsize()} messages): wait for the workers")
+        await self.queue.put((priority, next(self.counter), dict_infos, date_utc))
+
+    def hold(self, account: str, last_id: int):
+        """
+        Keep the watermark of an account at most at `last_id`, the last message put by its backfill in progress
+        """
+        self.cursors[account.lower()] = last_id
+
+    def release(self, account: str):
+        """
+        Let the watermark of an account pass its backfill, once it is over
+        """
+        self.cursors.pop(account.lower(), None)
+        self._advance(account)
+
+    def written(self, records: list[dict]) -> dict[str, int]:
+        """
+        Mark the records as written in the store; return the watermark of each account
+        """
+        accounts = set()
+        for record in records:
+            account = record['account']
+            self.pending[account].difference_update(self.parts.pop((account, record['id']), [record['id']]))
+            accounts.add(account)
+        for account in accounts:
+            self._advance(account)
+        return dict(self.watermarks)
+
+    def _advance(self, account: str):
+        pending, seen = self.pending[account], self.seen[account]
+        watermark = (min(pending) - 1) if pending else max(seen, default=0)
+        if account.lower() in self.cursors:
+            watermark = min(watermark, self.cursors[account.lower()])
+        watermark = max(watermark, self.watermarks.get(account, 0))
+
+        self.watermarks[account] = watermark
+        self.seen[account] = {i for i in seen if i > watermark}
+
+
+async def backfill_channel(client, ingestion: LiveIngestion, channel: str, min_id: int, entities=None, max_retries: int = 5) -> int:
+    """
+    Put the messages of a channel posted after `min_id` in the queue, from the oldest to the newest.
+    On a FloodWaitError, wait for the requested time and resume after the last message fetched.
+    The watermark of the channel is held at the last message fetched until the backfill is over.
+    """
+    n_messages = 0
+    ingestion.hold(channel, min_id)
+    for _ in range(max_retries + 1):
+        try:
+            entity = await client.get_entity(channel)
+            account = entities.account(utils.get_peer_id(entity)) if entities else channel
+            async for message in client.iter_messages(entity, min_id=min_id, reverse=True):
+                min_id = max(min_id, message.id)
+                n_messages += await ingestion.put(message, account)
+                ingestion.hold(account, min_id)
+            ingestion.release(account)
+            return n_messages
+        except errors.FloodWaitError as e:
+            logger.warning(f"Flood wait of {e.seconds} sec during the backfill of {channel}")
+            await asyncio.sleep(e.seconds)
+
+    # The watermark stays held, so that the remaining messages are fetched again by the next backfill
+    logger.error(f"Backfill of {channel} stopped after {max_retries} flood waits, at message id {min_id}")
+    return n_messages
+
+
+async def backfill(client, ingestion: LiveIngestion, channels: list[str], last_ids: dict[str, int], entities=None, concurrency: int = 4) -> int:
+    """
+    Catch up the messages posted while the live was down, with up to `concurrency` channels fetched at once.
+    Channels never seen by the live are not backfilled. The watermarks of the other ones are held from the start,
+    so that the new messages written meanwhile do not move them past the messages still to fetch.
+    Args:
+        client: Telethon client (or any object with the async get_entity and iter_messages methods)
+        ingestion (LiveIngestion): entry point of the queue, shared with the handler of the new messages
+        channels (list[str]): usernames of the channels of the datamap
+        last_ids (dict[str, int]): watermark of each account, after which the messages are fetched (see LiveStore.last_ids)
+        entities (EntityCache): names of the channels by peer id, as used by the handler of the new messages
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    last_ids = {account.lower(): last_id for account, last_id in last_ids.items()}  # usernames are case-insensitive
+
+    async def run(channel):
+        async with semaphore:
+            try:
+                return await backfill_channel(client, ingestion, channel, last_ids[channel.lower()], entities)
+            except Exception as e:
+                logger.error(f"Backfill of {channel} failed: {e}")
+                return 0
+
+    channels = [channel for channel in channels if channel.lower() in last_ids]
+    for channel in channels:
+        ingestion.hold(channel, last_ids[channel.lower()])
+    n_messages = sum(await asyncio.gather(*(run(channel) for channel in channels)))
+    logger.info(f"Backfill: {n_messages} messages missed on {len(channels)} channels")
+    return n_messages
@@ -0,0 +1,86 @@
+import re
+import sqlite3
+import threading
+
+
+def build_search_index(path: str, messages: list[dict]):
+    """
+    Write a SQLite FTS5 index of the translation and the original text of the messages, whose rowid is the
+    position of the message in the list (i.e. its row in the columnar layout, sorted by date)
+    """
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('DROP TABLE IF EXISTS messages')
+        connection.execute("""
+            CREATE VIRTUAL TABLE messages USING fts5(
+                text_english, text, account UNINDEXED,
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )""")
+        connection.executemany('INSERT INTO messages (rowid, text_english, text, account) VALUES (?, ?, ?, ?)',
+                               [(row, m['text_english'] or '', m['text'] or '', m['account']) for row, m in enumerate(messages)])
+        connection.execute("INSERT INTO messages (messages) VALUES ('optimize')")
+    connection.close()
+
+
+def fts_query(text: str) -> str | None:
+    """
+    Convert the text typed in the quick filter into a FTS5 query: all the words must match, each one as a prefix
+    (so that the last word can still be typed), and the words between double quotes as a phrase.
+    Return None if there is nothing to search.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        # Only the letters and digits are indexed by the tokenizer
+        if phrase and re.search(r'\w', phrase):
+            terms.append('"' + phrase + '"')
+        elif word and re.search(r'\w', word):
+            terms.append('"' + word.replace('"', '') + '"*')
+    return ' '.join(terms) or None
+
+
+class SearchIndex:
+    """
+    Full-text search in the messages of a datamap, in the index written by build_search_index
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+
+    def search(self, text: str, row_start: int = None, row_end: int = None, account: str = None) -> list[int]:
+        """
+        Return the rows of the messages matching a text (see fts_query), optionally in the rows [row_start, row_end)
+        of a date window and of a single account, sorted by row (i.e. by date)
+        """
+        query = fts_query(text)
+        if query is None:
+            return []
+
+        conditions, params = ['messages MATCH ?'], [query]
+        if row_start is not None:
+            conditions.append('rowid >= ?')
+            params.append(row_start)
+        if row_end is not None:
+            conditions.append('rowid < ?')
+            params.append(row_end)
+        if account:
+            conditions.append('account = ?')
+            params.append(account)
+
+        with self.lock:
+            rows = self.connection.execute('SELECT rowid FROM messages WHERE ' + ' AND '.join(conditions) + ' ORDER BY rowid', params).fetchall()
+        return [row for row, in rows]
+
+    def cache_bytes(self) -> int:
+        """
+        Upper bound of the memory held by the connection: the size of its page cache
+        (cache_size is a number of pages, or a number of KiB when negative)
+        """
+        with self.lock:
+            cache_size, = self.connection.execute('PRAGMA cache_size').fetchone()
+            page_size, = self.connection.execute('PRAGMA page_size').fetchone()
+        return -cache_size * 1024 if cache_size < 0 else cache_size * page_size
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,202 @@
+import os
+import json
+import click
+import sqlite3
+import threading
+from typing import Callable
+from loguru import logger
+
+
+class LiveStore:
+    """
+    Transactional store of the enhanced messages of the live, in SQLite (WAL mode), written by live.py
+    and read concurrently by liveapp.py. A message is unique by (account, id): writing it again
+    (e.g. the catch-up of a deferred message) replaces it and gives it a new rowid, so that the readers
+    following the rowid see the update; the rowid of its first version is kept, so that they can tell it from a new message.
+    Messages are buffered by `append` and written in a single transaction by `flush` (group commit), together with
+    the watermark of each account: the id up to which all the messages of the account were written, so that
+    the backfill resumes after it (the messages are written out of order by the workers of live.py).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+                account TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                record TEXT NOT NULL,
+                first_rowid INTEGER,
+                UNIQUE (account, id)
+            )""")
+        # Stores written before the column first_rowid
+        if 'first_rowid' not in [column for _, column, *_ in self.connection.execute('PRAGMA table_info(messages)')]:
+            self.connection.execute('ALTER TABLE messages ADD COLUMN first_rowid INTEGER')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                account TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            )""")
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_date ON messages (date)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_account ON messages (account, date)')
+        self.connection.commit()
+
+    @classmethod
+    def of_datamap(cls, datamap_dir: str):
+        return cls(os.path.join(datamap_dir, 'telegram_gemini.sqlite'))
+
+    # --- Writes ---
+
+    def append(self, record: dict):
+        with self.lock:
+            self.buffer.append(record)
+
+    def flush(self, watermarks: Callable[[list[dict]], dict[str, int]] = None) -> int:
+        """
+        Write the buffered messages in a single transaction; return the number of messages written.
+        If given, `watermarks` is called with the messages and returns the watermarks to write with them
+        (e.g. LiveIngestion.written).
+        """
+        with self.lock:
+            records, self.buffer = self.buffer, []
+            if records:
+                self.write(records, watermarks(records) if watermarks else None)
+        return len(records)
+
+    def write(self, records: list[dict], watermarks: dict[str, int] = None):
+        with self.connection:
+            # first_rowid is NULL for the first version of a message, else the rowid of its first version
+            self.connection.executemany("""
+                INSERT OR REPLACE INTO messages (account, id, date, record, first_rowid)
+                VALUES (?, ?, ?, ?, (SELECT COALESCE(first_rowid, rowid) FROM messages WHERE account = ? AND id = ?))""",
+                [(r['account'], r['id'], r['date'], json.dumps(r, ensure_ascii=False), r['account'], r['id']) for r in records])
+            if watermarks:
+                self.connection.executemany('INSERT OR REPLACE INTO watermarks (account, last_id) VALUES (?, ?)', watermarks.items())
+
+    # --- Reads ---
+
+    def read_since(self, rowid: int = 0, limit: int = None) -> tuple[list[dict], int, set[tuple[str, int]]]:
+        """
+        Return the messages written after a rowid (in their order of writing), the last rowid read, and the
+        (account, id) of the messages among them replacing a version written up to this rowid (i.e. already read)
+        """
+        query = 'SELECT rowid, record, account, id, first_rowid FROM messages WHERE rowid > ? ORDER BY rowid'
+        params = [rowid]
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        replaced = {(account, id) for _, _, account, id, first_rowid in rows if (first_rowid is not None) and (first_rowid <= rowid)}
+        return [json.loads(record) for _, record, *_ in rows], (rows[-1][0] if rows else rowid), replaced
+
+    def read_window(self, date_start: str = None, date_end: str = None, account: str = None, limit: int = None) -> list[dict]:
+        """
+        Return the messages of [date_start, date_end), optionally of a single account, sorted by date.
+        Dates are compared as strings in the format YYYY-MM-DD HH:MM:SS (or a prefix of it).
+        If `limit` is given, only the most recent messages are returned.
+        """
+        conditions, params = [], []
+        if date_start:
+            conditions.append('date >= ?')
+            params.append(date_start)
+        if date_end:
+            conditions.append('date < ?')
+            params.append(date_end)
+        if account:
+            conditions.append('account = ?')
+            params.append(account)
+
+        query = 'SELECT record FROM messages' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') + ' ORDER BY date DESC, id DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [json.loads(record) for record, in reversed(rows)]
+
+    def count(self, date_start: str = None, date_end: str = None) -> int:
+        """
+        Return the number of messages of [date_start, date_end)
+        """
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM messages WHERE date >= ? AND date < ?',
+                                           (date_start or '', date_end or '\uffff')).fetchone()[0]
+
+    def date_at_rank(self, rank: int) -> str | None:
+        """
+        Return the date of the rank-th most recent message (1 for the last one), or None if there are fewer messages
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT date FROM messages ORDER BY date DESC LIMIT 1 OFFSET ?', (rank - 1,)).fetchone()
+        return row[0] if row else None
+
+    def last_rowid(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COALESCE(MAX(rowid), 0) FROM messages').fetchone()[0]
+
+    def last_ids(self) -> dict[str, int]:
+        """
+        Return the watermark of each account, after which the backfill resumes: all the messages up to it were written.
+        Accounts without watermark (e.g. imported by import_jsonl) resume after their last message.
+        """
+        with self.lock:
+            last_ids = dict(self.connection.execute('SELECT account, MAX(id) FROM messages GROUP BY account').fetchall())
+            return last_ids | dict(self.connection.execute('SELECT account, last_id FROM watermarks').fetchall())
+
+    def deferred(self) -> list[dict]:
+        """
+        Return the messages only translated under backlog (flagged 'deferred'), whose complete analysis is still to do
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT record FROM messages WHERE json_extract(record, '$.deferred') ORDER BY rowid").fetchall()
+        return [json.loads(record) for record, in rows]
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def import_jsonl(store: LiveStore, jsonl_path: str, chunk_size: int = 10_000) -> int:
+    """
+    Import the messages of a JSONL file written by a previous version of live.py; a partially written line is ignored
+    """
+    n_messages, records = 0, []
+    with open(jsonl_path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"Ignore an incomplete line of {jsonl_path}")
+                continue
+            if len(records) == chunk_size:
+                store.write(records)
+                n_messages, records = n_messages + len(records), []
+    store.write(records)
+    return n_messages + len(records)
+
+
+@click.command()
+@click.option('--datamap', required=True, help='Name of the datamap')
+def main(datamap):
+    datamap_dir = os.path.join(os.path.dirname(__file__), '../../data/datamaps', datamap)
+    store = LiveStore.of_datamap(datamap_dir)
+    n_messages = import_jsonl(store, os.path.join(datamap_dir, 'telegram_gemini.jsonl'))
+    logger.success(f"Imported {n_messages} records into {store.path} ({len(store)} messages)")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
+
+# uv run store.py --datamap live
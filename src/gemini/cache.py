@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(__file__), '../../data/.cache/structured_analysis.sqlite')
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a text so that reposts with different spacing or unicode forms share the same key
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+class AnalysisCache:
+    """
+    Persistent content-addressed cache for the structured analyses of Gemini, stored in SQLite.
+    Entries are keyed by a hash of (normalized text, prompt template, region, languages, model)
+    and evicted when older than `max_age_days` or when there are more than `max_entries` entries
+    (least recently used first).
+    Writes (new entries and access times) are buffered and committed in groups of `flush_size`, or after
+    `flush_interval` seconds; `aget` and `aput` run the SQLite calls in a thread, off the event loop.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 500_000, max_age_days: float = 90,
+                 flush_size: int = 100, flush_interval: float = 5.0):
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 3600
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.hits, self.misses, self.n_puts = 0, 0, 0
+        self.pending = {}    # key -> (value, created) of the entries not written yet
+        self.accessed = {}   # key -> time of the last hit not written yet
+        self.last_flush = time.time()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_accessed ON analyses (accessed)')
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(text: str, prompt_template: str, region: str, languages: str, model: str) -> str:
+        payload = json.dumps([normalize_text(text), prompt_template, region, languages, model], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            now = time.time()
+            if key in self.pending:
+                value, created = self.pending[key]
+            else:
+                row = self.connection.execute('SELECT value, created FROM analyses WHERE key = ?', (key,)).fetchone()
+                value, created = row if row else (None, 0)
+            if (value is None) or (now - created > self.max_age):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.accessed[key] = now
+            self._flush_if_due(now)
+            return json.loads(value)
+
+    def put(self, key: str, value):
+        if value is None:  # failed analyses are not cached
+            return
+
+        with self.lock:
+            now = time.time()
+            self.pending[key] = (json.dumps(value, ensure_ascii=False), now)
+            self.n_puts += 1
+            self._flush_if_due(now)
+
+        if self.n_puts % 1000 == 0:
+            self.evict()
+
+    async def aget(self, key: str):
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, value):
+        await asyncio.to_thread(self.put, key, value)
+
+    def _flush_if_due(self, now: float):
+        if (len(self.pending) + len(self.accessed) >= self.flush_size) or (now - self.last_flush >= self.flush_interval):
+            self._flush()
+
+    def _flush(self):
+        """
+        Write the buffered entries and access times in a single transaction (the lock must be held)
+        """
+        if self.pending or self.accessed:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO analyses (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                                            [(key, value, created, created) for key, (value, created) in self.pending.items()])
+                self.connection.executemany('UPDATE analyses SET accessed = ? WHERE key = ?',
+                                            [(accessed, key) for key, accessed in self.accessed.items()])
+            self.pending, self.accessed = {}, {}
+        self.last_flush = time.time()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def evict(self):
+        """
+        Remove the entries that are too old, then the least recently used ones above max_entries
+        """
+        with self.lock:
+            self._flush()
+            self.connection.execute('DELETE FROM analyses WHERE created < ?', (time.time() - self.max_age,))
+            self.connection.execute("""
+                DELETE FROM analyses WHERE key IN (
+                    SELECT key FROM analyses ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            self._flush()
+            return self.connection.execute('SELECT COUNT(*) FROM analyses').fetchone()[0]
+
+    def stats(self) -> str:
+        n_requests = self.hits + self.misses
+        hit_rate = self.hits / n_requests if n_requests else 0.0
+        return f"{self.hits} hits, {self.misses} misses (hit rate: {hit_rate:0.1%}), {len(self)} entries"
+
+
+_cache = None
+
+def get_cache() -> AnalysisCache:
+    """
+    Return the cache shared by all the analyses of this process (opened on first use)
+    """
+    global _cache
+    if _cache is None:
+        _cache = AnalysisCache()
+        atexit.register(_cache.flush)
+    return _cache
@@ -0,0 +1,92 @@
+from collections import Counter
+from loguru import logger
+
+try:
+    from .structured_output import structured_analysis, async_structured_analysis
+except ImportError:
+    from structured_output import structured_analysis, async_structured_analysis
+
+# Cheaper model with a higher quota first, then the model used for the batch enrichment
+CASCADE_MODELS = ('gemini-2.0-flash-lite', 'gemini-2.0-flash')
+
+
+def unreliable_reason(output, text: str, bbox: list[float] = None, tolerance: float = 0.05) -> str | None:
+    """
+    Return why the output of a model looks unreliable, or None if it looks fine
+    Args:
+        output (StructuredAnalysis): output of structured_analysis
+        text (str): analyzed post
+        bbox (list[float]): bounding box of the datamap [south, west, north, east], if any
+        tolerance (float): maximal difference between the sum of the sentiment probabilities and 1
+    """
+    if not output:
+        return 'no output'
+    if text.strip() and not output['translation'].strip():
+        return 'empty translation'
+    if abs(sum(output['sentiment'].values()) - 1) > tolerance:
+        return 'sentiment not summing to 1'
+    if bbox:
+        south, west, north, east = bbox
+        if any(not (south <= g['latitude'] <= north and west <= g['longitude'] <= east) for g in output['geolocations']):
+            return 'geolocation outside the map'
+    return None
+
+
+class CascadeStats:
+    """
+    Number of outputs served by each tier of the cascade, and reasons of the escalations
+    """
+
+    def __init__(self):
+        self.tiers = Counter()
+        self.reasons = Counter()
+
+    def reset(self):
+        self.tiers.clear()
+        self.reasons.clear()
+
+    def record(self, model: str, reason: str = None):
+        self.tiers[model] += 1
+        if reason:
+            self.reasons[reason] += 1
+
+    def summary(self) -> str:
+        total = max(sum(self.tiers.values()), 1)
+        tiers = ', '.join(f"{model} {n} ({n / total:0.0%})" for model, n in self.tiers.items())
+        return f"{tiers}; escalations: {dict(self.reasons) or 'none'}"
+
+
+cascade_stats = CascadeStats()
+
+
+def cascade_analysis(client, text: str, prompt_template: str, region: str, languages: str, models: tuple[str] = CASCADE_MODELS,
+                     bbox: list[float] = None, use_cache=True):
+    """
+    Analyze a post with the first model of the cascade, and escalate to the next one only if the output looks unreliable.
+    The output of the last model is returned, even if it still looks unreliable.
+    """
+    for tier, model in enumerate(models):
+        output = structured_analysis(client, text, prompt_template, region, languages, model_google=model, use_cache=use_cache)
+        reason = unreliable_reason(output, text, bbox) if tier < len(models) - 1 else None
+        if reason is None:
+            cascade_stats.record(model)
+            return output
+        cascade_stats.record(f'{model} (escalated)', reason)
+        logger.debug(f"Escalate from {model}: {reason}")
+
+
+async def async_cascade_analysis(client, text: str, prompt_template: str, region: str, languages: str, models: tuple[str] = CASCADE_MODELS,
+                                 bbox: list[float] = None, use_cache=True, budget=None, output=None):
+    """
+    Same as cascade_analysis, but using the async client of genai (client.aio).
+    If the output of the first model is already known (e.g. from a batch), it is given as `output`.
+    """
+    for tier, model in enumerate(models):
+        if (tier > 0) or (output is None):
+            output = await async_structured_analysis(client, text, prompt_template, region, languages, model_google=model, use_cache=use_cache, budget=budget)
+        reason = unreliable_reason(output, text, bbox) if tier < len(models) - 1 else None
+        if reason is None:
+            cascade_stats.record(model)
+            return output
+        cascade_stats.record(f'{model} (escalated)', reason)
+        logger.debug(f"Escalate from {model}: {reason}")
@@ -0,0 +1,89 @@
+import zlib
+import numpy as np
+from collections import defaultdict
+
+try:
+    from .cache import normalize_text
+except ImportError:
+    from cache import normalize_text
+
+# Universal hashing (a * x + b) mod P, with P a prime larger than 2**32 and a < 2**31 to avoid overflows in uint64
+_PRIME = np.uint64(4294967311)
+
+
+def shingles(text: str, k: int = 5) -> np.ndarray:
+    """
+    Return the hashes of the character k-grams of a normalized text
+    """
+    text = ' '.join(text.lower().split())
+    grams = {text[i:i + k] for i in range(max(len(text) - k + 1, 1))}
+    return np.array([zlib.crc32(g.encode('utf-8')) for g in grams], dtype=np.uint64)
+
+
+def minhash_signatures(texts: list[str], num_perm: int = 128, seed: int = 0) -> np.ndarray:
+    """
+    Return the MinHash signatures of the texts, as an array of shape (len(texts), num_perm)
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**31, size=num_perm, dtype=np.uint64)[:, None]
+    b = rng.integers(0, 2**31, size=num_perm, dtype=np.uint64)[:, None]
+
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        signatures[i] = ((a * shingles(text)[None, :] + b) % _PRIME).min(axis=1)
+    return signatures
+
+
+def cluster_near_duplicates(texts: list[str], threshold: float = 0.9, num_perm: int = 128, bands: int = 32) -> list[int]:
+    """
+    Cluster near-duplicate texts with MinHash and locality-sensitive hashing (banding), in sub-quadratic time.
+    Two texts are in the same cluster if they share a bucket in at least one band
+    and if their estimated Jaccard similarity is above the threshold.
+    Args:
+        texts (list[str]): texts to cluster
+        threshold (float): minimal estimated Jaccard similarity between character 5-grams
+        num_perm (int): number of hash functions of the signatures
+        bands (int): number of bands (num_perm must be a multiple of bands)
+    Returns:
+        list[int]: for each text, the index of the representative of its cluster (its first text)
+    """
+    if not texts:
+        return []
+
+    signatures = minhash_signatures(texts, num_perm=num_perm)
+    rows = num_perm // bands
+
+    # Union-find where the root is always the smallest index
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for i, signature in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets[signature.tobytes()].append(i)
+
+        for members in buckets.values():
+            first = members[0]
+            for i in members[1:]:
+                root_first, root_i = find(first), find(i)
+                if (root_first != root_i) and (np.mean(signatures[first] == signatures[i]) >= threshold):
+                    parent[max(root_first, root_i)] = min(root_first, root_i)
+
+    return [find(i) for i in range(len(texts))]
+
+
+def cluster_exact_duplicates(texts: list[str]) -> list[int]:
+    """
+    Cluster the texts that are identical after normalization (unicode form and spacing, as the keys of the cache).
+    Unlike near-duplicates, texts differing only by a number or a place name are kept apart: the analysis of
+    the representative can be copied to the others as is.
+    Returns:
+        list[int]: for each text, the index of the representative of its cluster (its first text)
+    """
+    first = {}
+    return [first.setdefault(normalize_text(text), i) for i, text in enumerate(texts)]
@@ -0,0 +1,128 @@
+import os
+import sys
+import yaml
+import click
+import asyncio
+from google import genai
+from loguru import logger
+from time import perf_counter
+
+from enrichment import enrich_messages
+from structured_output import context_caches
+from cascade import CASCADE_MODELS
+from quota import QuotaBudget, QuotaBudgets, MODEL_QUOTAS
+from rate_control import rate_controller
+
+sys.path.append('..')
+from data_telegram.journal import load_messages
+
+
+async def log_progress(accounts: dict, period: float = 60):
+    """
+    Log the progress of each account periodically
+    """
+    while True:
+        await asyncio.sleep(period)
+        logger.info('Progress: ' + ', '.join(f"{account} {a['enriched']}/{a['total']}" for account, a in accounts.items()))
+
+
+async def enrich_datamap(client, datamap_dir: str, list_accounts: list[str], region: str, languages: str, budget: QuotaBudgets,
+                         model_google: str, concurrency: int, batch_size: int, use_cache: bool, dedup: bool,
+                         escalate_model: str = None, bbox: list[float] = None) -> dict:
+    """
+    Enrich all the accounts of a datamap with a single pool of `concurrency` workers sharing the same budget.
+    Messages of all accounts are enriched together, so that near-duplicates between accounts are sent only once.
+    """
+    # Load all messages, and remember the account of each of them
+    accounts, all_messages, owners = {}, [], []
+    for account in list_accounts:
+        messages, journal = load_messages(os.path.join(datamap_dir, account), account, method='gemini')
+        n_enriched = sum('text_english' in m for m in messages)
+        accounts[account] = {'journal': journal, 'start': len(all_messages), 'total': len(messages),
+                             'already': n_enriched, 'enriched': n_enriched}
+        all_messages.extend(messages)
+        owners.extend([account] * len(messages))
+
+    def on_enriched(i, message):
+        account = accounts[owners[i]]
+        account['journal'].append(message)
+        account['enriched'] += 1
+
+    progress_task = asyncio.create_task(log_progress(accounts))
+    try:
+        await enrich_messages(client, all_messages, region=region, languages=languages, concurrency=concurrency, batch_size=batch_size,
+                              use_cache=use_cache, dedup=dedup, model_google=model_google, escalate_model=escalate_model, bbox=bbox, budget=budget, on_enriched=on_enriched,
+                              desc=f"Converting messages of {os.path.basename(datamap_dir)}")
+    finally:
+        progress_task.cancel()
+
+    # Compact the journal of each account into its final file
+    for account, a in accounts.items():
+        a['journal'].compact(all_messages[a['start']:a['start'] + a['total']], os.path.join(datamap_dir, account, 'gemini.json'))
+
+    return accounts
+
+
+@click.command()
+@click.option('--datamap', required=True, help='Name of the datamap')
+@click.option('--model', default='gemini-2.0-flash', show_default=True, type=click.Choice(list(MODEL_QUOTAS)), help='Gemini model, its free-tier limits are used as a preset')
+@click.option('--rpm', type=int, help='Requests per minute shared by all accounts (default: preset of the model, of the first tier with --cascade)')
+@click.option('--tpm', type=int, help='Tokens per minute shared by all accounts (default: preset of the model, of the first tier with --cascade)')
+@click.option('--concurrency', default=8, show_default=True, help='Maximal number of requests in flight')
+@click.option('--batch-size', default=1, show_default=True, help='Number of messages packed in a single request')
+@click.option('--no-cache', is_flag=True, help='Do not use the persistent cache of analyses')
+@click.option('--no-dedup', is_flag=True, help='Do not detect duplicate messages before the enrichment')
+@click.option('--cascade', is_flag=True, help=f'Analyze with {CASCADE_MODELS[0]} first, and escalate the unreliable outputs to --model')
+@click.option('--context-cache', is_flag=True, help='Store the instructions of the prompt in a context cache of the Google API')
+def main(datamap, model, rpm, tpm, concurrency, batch_size, no_cache, no_dedup, cascade, context_cache):
+
+    # Login to the Google API
+    config_path = os.path.join(os.path.dirname(__file__), '../../config.yaml')
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+        GOOGLE_API_KEY = config['secret_keys']['google']['api_key']
+
+    # Get the configuration of the datamap
+    datamap_dir = os.path.join('../../data/datamaps', datamap)
+    with open(os.path.join(datamap_dir, 'datamap-config.yaml')) as f:
+        config = yaml.safe_load(f)
+        REGION = config['map']['region']
+        LANGUAGES = config['map']['languages']
+        BBOX = config['map'].get('bbox')
+
+    # Accounts of the datamap, as in create_datamap.py
+    list_accounts = sorted(f for f in os.listdir(datamap_dir) if os.path.exists(os.path.join(datamap_dir, f, 'result.json')))
+    logger.info(f"Enrich {len(list_accounts)} accounts of {datamap}: {', '.join(list_accounts)}")
+
+    # With the cascade, most of the requests are sent to the first tier (--rpm and --tpm apply to it),
+    # and the escalated ones are charged to the budget of --model
+    first_model = CASCADE_MODELS[0] if cascade else model
+    budgets = {first_model: QuotaBudget.from_model(first_model, rpm=rpm, tpm=tpm)}
+    if cascade and (model != first_model):
+        budgets[model] = QuotaBudget.from_model(model)
+    budget = QuotaBudgets(budgets)
+    # The quota shared with the other processes of this API key follows the same overrides
+    if rpm or tpm:
+        rate_controller.quota.override(first_model, rpm=rpm, tpm=tpm)
+    for budget_model, model_budget in budget.budgets.items():
+        logger.info(f"Shared budget for {budget_model}: {model_budget.rpm} requests/min, {model_budget.tpm} tokens/min")
+
+    client = genai.Client(api_key=GOOGLE_API_KEY)
+    context_caches.enabled = context_cache
+
+    tic = perf_counter()
+    accounts = asyncio.run(enrich_datamap(client, datamap_dir, list_accounts, REGION, LANGUAGES, budget, model_google=first_model,
+                                          concurrency=concurrency, batch_size=batch_size, use_cache=not no_cache, dedup=not no_dedup,
+                                          escalate_model=model if cascade and (model != first_model) else None, bbox=BBOX))
+
+    # Final summary per account
+    logger.info(f"Summary of {datamap} ({perf_counter() - tic:0.1f} sec)")
+    for account, a in accounts.items():
+        log = logger.success if a['enriched'] == a['total'] else logger.warning
+        log(f"{account:<24} {a['enriched']:>6}/{a['total']:<6} enriched ({a['enriched'] - a['already']} in this run)")
+
+
+if __name__ == '__main__':
+    main()
+
+# uv run enrich_datamap.py --datamap sample --model gemini-2.0-flash-lite
@@ -0,0 +1,146 @@
+import asyncio
+from tqdm import tqdm
+from google import genai
+from loguru import logger
+from time import perf_counter
+
+try:
+    from .cache import get_cache
+    from .cascade import async_cascade_analysis, cascade_stats
+    from .dedup import cluster_exact_duplicates
+    from .preclassifier import preclassifier_stats
+    from .rate_control import rate_controller
+    from .structured_output import async_structured_analysis, async_structured_analysis_batch, format_output, usage, EMPTY_ANALYSIS, COMBINED_PROMPT
+except ImportError:
+    from cache import get_cache
+    from cascade import async_cascade_analysis, cascade_stats
+    from dedup import cluster_exact_duplicates
+    from preclassifier import preclassifier_stats
+    from rate_control import rate_controller
+    from structured_output import async_structured_analysis, async_structured_analysis_batch, format_output, usage, EMPTY_ANALYSIS, COMBINED_PROMPT
+
+
+async def enrich_messages(client, messages: list[dict], region: str, languages: str, concurrency: int = 8, batch_size: int = 1, use_cache: bool = True, dedup: bool = True,
+                          model_google: str = 'gemini-2.0-flash', escalate_model: str = None, bbox: list[float] = None,
+                          prompt_template: str = COMBINED_PROMPT, budget=None, on_enriched=None, desc: str = 'Converting messages') -> list[dict]:
+    """
+    Enrich all the messages without 'text_english' with up to `concurrency` requests in flight.
+    Messages are updated in place, so their order is kept.
+    Args:
+        client: genai client (its async client is used)
+        messages (list[dict]): raw or partially enhanced messages
+        region (str): region of the datamap
+        languages (str): languages of the datamap
+        concurrency (int): maximal number of requests in flight
+        batch_size (int): number of messages packed in a single request (1 to send them one by one)
+        use_cache (bool): look for the analyses in the persistent cache before calling Gemini
+        dedup (bool): only enrich one representative per group of identical texts (after normalization) and copy its results to the others
+        model_google (str): Gemini model, or first tier of the cascade if `escalate_model` is given
+        escalate_model (str): model used when the output of `model_google` looks unreliable (e.g. outside the bounding box)
+        bbox (list[float]): bounding box of the datamap [south, west, north, east], used to check the geolocations
+        budget (QuotaBudgets): requests-per-minute and tokens-per-minute budget of each model, shared by all the requests
+        on_enriched (callable): called with (index, message) each time a message is enriched
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    todo = [i for i, message in enumerate(messages) if 'text_english' not in message]
+    progress = tqdm(total=len(todo), desc=desc, leave=True)
+    n_enriched = 0
+    duplicates = {}  # index of a representative -> indices of its duplicates
+
+    def update(i, results):
+        nonlocal n_enriched
+        for j in [i] + duplicates.get(i, []):
+            messages[j] = messages[j] | results
+            n_enriched += 1
+            if on_enriched:
+                on_enriched(j, messages[j])
+        progress.update(len(duplicates.get(i, [])))
+
+    async def enrich(i):
+        message = messages[i]
+        async with semaphore:
+            try:
+                if escalate_model:
+                    output = await async_cascade_analysis(client, message['text'], prompt_template=prompt_template, region=region, languages=languages,
+                                                          models=(model_google, escalate_model), bbox=bbox, use_cache=use_cache, budget=budget)
+                else:
+                    output = await async_structured_analysis(client, message['text'], prompt_template=prompt_template,
+                                                             region=region, languages=languages, model_google=model_google, use_cache=use_cache, budget=budget)
+            except genai.errors.APIError as e:
+                logger.error(f"Google API error at message id {message['id']}: {e}")
+                output = None
+
+        if output:
+            update(i, format_output(output))
+        else:
+            logger.warning(f"None returned as output by Google API at message id {message['id']}")
+            progress.update(len(duplicates.get(i, [])))
+        progress.update()
+
+    async def enrich_batch(indices):
+        # Messages are keyed by their index, since message ids may collide between accounts
+        async with semaphore:
+            try:
+                outputs = await async_structured_analysis_batch(client, {i: messages[i]['text'] for i in indices},
+                                                                region=region, languages=languages, model_google=model_google, use_cache=use_cache, budget=budget)
+            except genai.errors.APIError as e:
+                logger.error(f"Google API error at message ids {[messages[i]['id'] for i in indices]}: {e}")
+                outputs = {}
+
+        # Only the unreliable outputs of the batch are sent again to the escalation model
+        if escalate_model:
+            async def escalate(i):
+                try:
+                    return await async_cascade_analysis(client, messages[i]['text'], prompt_template=COMBINED_PROMPT, region=region, languages=languages,
+                                                        models=(model_google, escalate_model), bbox=bbox, use_cache=use_cache, budget=budget, output=outputs.get(i) or {})
+                except genai.errors.APIError as e:
+                    logger.error(f"Google API error at message id {messages[i]['id']}: {e}")
+            outputs = dict(zip(indices, await asyncio.gather(*(escalate(i) for i in indices))))
+
+        for i in indices:
+            if outputs.get(i):
+                update(i, format_output(outputs[i]))
+            else:
+                logger.warning(f"None returned as output by Google API at message id {messages[i]['id']}")
+                progress.update(len(duplicates.get(i, [])))
+        progress.update(len(indices))
+
+    # Messages without any text do not need any request
+    for i in [i for i in todo if not messages[i]['text']]:
+        update(i, EMPTY_ANALYSIS)
+        progress.update()
+    todo_text = [i for i in todo if messages[i]['text']]
+
+    # Duplicate texts (e.g. forwards between accounts) are only sent once. Near-duplicates are not merged:
+    # "3 drones" and "30 drones" must not share a translation nor geolocations.
+    if dedup and todo_text:
+        representatives = cluster_exact_duplicates([messages[i]['text'] for i in todo_text])
+        for i, representative in zip(todo_text, representatives):
+            if i != todo_text[representative]:
+                duplicates.setdefault(todo_text[representative], []).append(i)
+        n_saved = sum(len(members) for members in duplicates.values())
+        todo_text = [i for i, representative in zip(todo_text, representatives) if i == todo_text[representative]]
+        logger.info(f"Duplicate detection: {len(todo_text)} distinct texts for {len(todo_text) + n_saved} messages, {n_saved} API calls saved")
+
+    tic = perf_counter()
+    usage.reset()
+    preclassifier_stats.reset()
+    cascade_stats.reset()
+    if batch_size > 1:
+        await asyncio.gather(*(enrich_batch(todo_text[start:start + batch_size]) for start in range(0, len(todo_text), batch_size)))
+    else:
+        await asyncio.gather(*(enrich(i) for i in todo_text))
+    progress.close()
+
+    elapsed = perf_counter() - tic
+    logger.info(f"Enriched {n_enriched}/{len(todo)} messages in {elapsed:0.1f} sec "
+                f"({n_enriched / max(elapsed, 1e-9):0.2f} messages/sec, concurrency={concurrency}, batch_size={batch_size})")
+    logger.info(f"Pre-classifier: {preclassifier_stats.summary()}")
+    if escalate_model:
+        logger.info(f"Cascade: {cascade_stats.summary()}")
+    logger.info(f"Usage of Google API: {usage.summary()}")
+    logger.info(f"Rate controller: {rate_controller.stats()}")
+    if use_cache:
+        logger.info(f"Cache of analyses: {get_cache().stats()}")
+
+    return messages
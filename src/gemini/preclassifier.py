@@ -0,0 +1,107 @@
+import re
+import unicodedata
+from collections import Counter
+
+# Unicode ranges of the scripts of the datamaps
+SCRIPTS = {
+    'arabic': [(0x0600, 0x06FF), (0x0750, 0x077F), (0x08A0, 0x08FF), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF)],
+    'hebrew': [(0x0590, 0x05FF), (0xFB1D, 0xFB4F)],
+    'cyrillic': [(0x0400, 0x04FF), (0x0500, 0x052F)],
+    'latin': [(0x0041, 0x005A), (0x0061, 0x007A), (0x00C0, 0x024F)],
+}
+
+# Frequent English words, to tell English from the other languages written in the Latin script
+ENGLISH_WORDS = {'the', 'of', 'and', 'to', 'in', 'is', 'on', 'for', 'that', 'with', 'was', 'were', 'are', 'by', 'at',
+                 'from', 'this', 'has', 'have', 'had', 'it', 'as', 'be', 'an', 'after', 'their', 'they', 'his', 'her'}
+
+# One-liners announcing a message, translated without calling Gemini
+ALERTS = {'urgent': 'Urgent', 'breaking': 'Breaking', 'breaking news': 'Breaking news',
+          'عاجل': 'Urgent', 'عاجل جدا': 'Very urgent', 'خبر عاجل': 'Breaking news',
+          'דחוף': 'Urgent', 'מבזק': 'Breaking news', 'срочно': 'Urgent'}
+
+URL_PATTERN = re.compile(r'(https?://|www\.|t\.me/)\S+')
+MENTION_PATTERN = re.compile(r'[@#]\w+')
+
+
+def detect_script(text: str) -> str:
+    """
+    Return the dominant script of the letters of a text ('arabic', 'hebrew', 'cyrillic', 'latin', 'other'),
+    or 'none' if the text has no letter
+    """
+    counts = Counter()
+    for char in text:
+        if not char.isalpha():
+            continue
+        code = ord(char)
+        script = next((name for name, ranges in SCRIPTS.items() if any(start <= code <= end for start, end in ranges)), 'other')
+        counts[script] += 1
+    return counts.most_common(1)[0][0] if counts else 'none'
+
+
+def is_english(text: str, min_ratio: float = 0.15) -> bool:
+    """
+    Heuristic: a text in the Latin script where frequent English words are at least `min_ratio` of the words
+    """
+    if detect_script(text) != 'latin':
+        return False
+    words = re.findall(r"[a-z']+", text.lower())
+    return len(words) >= 3 and sum(w in ENGLISH_WORDS for w in words) / len(words) >= min_ratio
+
+
+def _strip(text: str) -> str:
+    """
+    Remove links, mentions, hashtags, emojis, punctuation and markdown of a text
+    """
+    text = MENTION_PATTERN.sub(' ', URL_PATTERN.sub(' ', text))
+    text = ''.join(c if unicodedata.category(c)[0] in 'LN' else ' ' for c in text)
+    return ' '.join(text.lower().split())
+
+
+def canned_analysis(text: str) -> dict | None:
+    """
+    Return the structured analysis of a trivial post (emojis, links or an alert one-liner only), else None
+    """
+    stripped = _strip(text)
+    if not any(c.isalpha() for c in stripped):
+        translation = text.strip()  # nothing to translate
+    elif stripped in ALERTS:
+        translation = ALERTS[stripped]
+    else:
+        return None
+    return {'translation': translation, 'geolocations': [], 'sentiment': {'negative': 0.0, 'neutral': 1.0, 'positive': 0.0}}
+
+
+def preclassify(text: str) -> tuple[str, dict | None]:
+    """
+    Classify a post before calling Gemini.
+    Returns:
+        tuple[str, dict | None]: ('trivial', canned analysis), ('english', None) or ('other', None)
+    """
+    if (output := canned_analysis(text)) is not None:
+        return 'trivial', output
+    if is_english(text):
+        return 'english', None
+    return 'other', None
+
+
+class PreclassifierStats:
+    """
+    Number of posts of each class seen by the pre-classifier, to report the calls avoided
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def reset(self):
+        self.counts.clear()
+
+    def record(self, kind: str):
+        self.counts[kind] += 1
+
+    def summary(self) -> str:
+        total = sum(self.counts.values())
+        return (f"{self.counts['trivial']}/{total} calls avoided (trivial posts), "
+                f"{self.counts['english']}/{total} calls without translation (English posts)")
+
+
+preclassifier_stats = PreclassifierStats()
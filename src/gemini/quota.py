@@ -0,0 +1,200 @@
+import os
+import time
+import yaml
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import deque
+from time import monotonic
+
+# Free-tier limits of the Google API: requests per minute, requests per day and tokens per minute
+MODEL_QUOTAS = {
+    'gemini-2.0-flash': {'rpm': 15, 'rpd': 1000, 'tpm': 1_000_000},
+    'gemini-2.0-flash-lite': {'rpm': 30, 'rpd': 1500, 'tpm': 1_000_000},
+    'gemini-2.5-flash-preview-04-17': {'rpm': 10, 'rpd': 500, 'tpm': 250_000},
+    'gemini-1.5-flash': {'rpm': 15, 'rpd': 500, 'tpm': 1_000_000},
+}
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../../config.yaml')
+
+
+def load_quotas(path: str = DEFAULT_CONFIG_PATH) -> dict:
+    """
+    Limits of each model: the free-tier presets, overridden by the optional section `quotas` of config.yaml
+    (e.g. `gemini-2.0-flash: {rpm: 2000, tpm: 4000000}` for a paid key)
+    """
+    quotas = {model: dict(limits) for model, limits in MODEL_QUOTAS.items()}
+    if os.path.exists(path):
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+        for model, limits in (config.get('quotas') or {}).items():
+            quotas[model] = quotas.get(model, {}) | limits
+    return quotas
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough estimation of the number of tokens of a prompt (about 4 characters per token)
+    """
+    return len(text) // 4 + 1
+
+
+class QuotaBudget:
+    """
+    Requests-per-minute and tokens-per-minute budget shared by all the concurrent requests of a process.
+    The budget is computed over a sliding window of 60 seconds; `acquire` waits until the request fits in it.
+    """
+
+    def __init__(self, rpm: int, tpm: int = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = deque()  # (time, tokens) of the requests of the last minute
+        self.tokens = 0
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def from_model(cls, model: str, rpm: int = None, tpm: int = None):
+        """
+        Budget of a model, using its limits of config.yaml or its free-tier limits as a preset
+        (limits are required for a model without preset)
+        """
+        preset = load_quotas().get(model.removeprefix('models/'), {})
+        if not (rpm or preset):
+            raise ValueError(f"No preset for the model {model}: give its limits with --rpm (and --tpm) or in config.yaml")
+        return cls(rpm=rpm or preset['rpm'], tpm=tpm or preset.get('tpm'))
+
+    def _expire(self, now: float):
+        while self.window and (now - self.window[0][0] >= 60):
+            self.tokens -= self.window.popleft()[1]
+
+    async def acquire(self, tokens: int = 0, model: str = None):
+        """
+        Wait until a request of `tokens` tokens fits in the budget (`model` is ignored: a budget is for a single model)
+        """
+        async with self.lock:  # requests are served in their order of arrival
+            while True:
+                now = monotonic()
+                self._expire(now)
+
+                fits_rpm = len(self.window) < self.rpm
+                fits_tpm = (self.tpm is None) or (self.tokens + tokens <= self.tpm) or (not self.window)
+                if fits_rpm and fits_tpm:
+                    self.window.append((now, tokens))
+                    self.tokens += tokens
+                    return
+
+                # Wait until the oldest request of the window expires
+                await asyncio.sleep(max(self.window[0][0] + 60 - now, 0.01))
+
+    def usage(self) -> str:
+        self._expire(monotonic())
+        return f"{len(self.window)}/{self.rpm} requests/min, {self.tokens}/{self.tpm} tokens/min"
+
+
+class QuotaBudgets:
+    """
+    One QuotaBudget per model, so that the requests escalated by the cascade to another model
+    are charged to the quota of that model. Budgets missing from `budgets` are created from the presets.
+    """
+
+    def __init__(self, budgets: dict[str, QuotaBudget] = None):
+        self.budgets = dict(budgets or {})
+
+    def __getitem__(self, model: str) -> QuotaBudget:
+        if model not in self.budgets:
+            self.budgets[model] = QuotaBudget.from_model(model)
+        return self.budgets[model]
+
+    async def acquire(self, tokens: int = 0, model: str = None):
+        await self[model].acquire(tokens)
+
+    def usage(self) -> str:
+        return '; '.join(f"{model}: {budget.usage()}" for model, budget in self.budgets.items())
+
+
+DEFAULT_QUOTA_PATH = os.path.join(os.path.dirname(__file__), '../../data/.cache/quota.sqlite')
+
+
+class SharedQuota:
+    """
+    Requests-per-minute and tokens-per-minute quota shared by all the processes using the same Google API key
+    on this machine (raw_to_enhanced.py, enrich_datamap.py, live.py, evaluation scripts, ...).
+    Each limit is a token bucket stored in SQLite: a process takes a lock on the database (BEGIN IMMEDIATE)
+    to refill and withdraw from the buckets, so the combined throughput stays under the quota.
+    The buckets are refilled at `safety` x the quota and hold at most `burst` x the quota, so that
+    any window of 60 seconds stays under the quota.
+    The limits are the free-tier presets by default, overridden by the section `quotas` of config.yaml.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUOTA_PATH, quotas: dict = None, safety: float = 0.9, burst: float = 0.1):
+        self.path = path
+        self.quotas = load_quotas() if quotas is None else quotas
+        self.safety, self.burst = safety, burst
+        self.connection = None
+        self.lock = threading.Lock()
+        self.wait_time = 0.0
+
+    def override(self, model: str, rpm: int = None, tpm: int = None):
+        """
+        Override the limits of a model (e.g. with the --rpm and --tpm of a script)
+        """
+        model = model.removeprefix('models/')
+        self.quotas = self.quotas | {model: self.quotas.get(model, {}) | {key: value for key, value in [('rpm', rpm), ('tpm', tpm)] if value}}
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)')
+        return self.connection
+
+    def _try_acquire(self, api_key: str, model: str, tokens: int) -> float:
+        """
+        Withdraw one request and `tokens` tokens from the buckets if possible and return 0,
+        else return the time to wait before trying again
+        """
+        limits = self.quotas.get(model.removeprefix('models/'))
+        if not limits:
+            return 0
+
+        prefix = hashlib.sha256(api_key.encode()).hexdigest()[:16] + ':' + model
+        costs = [(f'{prefix}:requests', limits['rpm'], 1)]
+        if limits.get('tpm'):
+            costs.append((f'{prefix}:tokens', limits['tpm'], tokens))
+
+        with self.lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                now, wait, levels = time.time(), 0.0, []
+                for key, per_minute, cost in costs:
+                    rate, capacity = self.safety * per_minute / 60, max(self.burst * per_minute, 1)
+                    row = connection.execute('SELECT level, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                    level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                    levels.append((key, level - cost))
+
+                    # A request larger than the bucket waits for a full bucket and leaves it in debt
+                    need = min(cost, capacity)
+                    if level < need:
+                        wait = max(wait, (need - level) / rate)
+
+                if wait == 0:
+                    connection.executemany('INSERT OR REPLACE INTO buckets (key, level, updated) VALUES (?, ?, ?)',
+                                           [(key, level, now) for key, level in levels])
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+        self.wait_time += wait
+        return wait
+
+    def acquire(self, api_key: str, model: str, tokens: int = 0):
+        while (wait := self._try_acquire(api_key, model, tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, api_key: str, model: str, tokens: int = 0):
+        # The lock of the database may be held by another process: wait for it in a thread, not in the event loop
+        while (wait := await asyncio.to_thread(self._try_acquire, api_key, model, tokens)) > 0:
+            await asyncio.sleep(wait)
@@ -11,6 +11,11 @@ from google.genai import types
 import chromadb
 from chromadb import Documents, EmbeddingFunction, Embeddings
 
+try:
+    from .rate_control import install_rate_controller
+except ImportError:
+    from rate_control import install_rate_controller
+
 
 class GeminiEmbeddingFunction(EmbeddingFunction):
     """
@@ -151,6 +156,9 @@ def main(datamap=None, query=None):
 
 
 if __name__ == "__main__":
+
+    # Retry on 429/503 with the rate controller of src/gemini
+    install_rate_controller()
     main()
 
 
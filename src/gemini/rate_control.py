@@ -0,0 +1,205 @@
+import re
+import random
+import asyncio
+import functools
+import threading
+from time import monotonic
+from loguru import logger
+from google import genai
+
+try:
+    from .quota import SharedQuota, estimate_tokens
+except ImportError:
+    from quota import SharedQuota, estimate_tokens
+
+
+def is_retriable(e):
+    return isinstance(e, genai.errors.APIError) and e.code in {429, 503}
+
+
+def retry_after(e) -> float | None:
+    """
+    Return the delay (in seconds) suggested by the Google API before retrying, if any:
+    either the Retry-After header or the RetryInfo of the error details (e.g. "retryDelay": "34s")
+    """
+    headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+
+    match = re.search(r"""retryDelay['"]?\s*:\s*['"]?(\d+(?:\.\d+)?)s""", str(getattr(e, 'details', '')))
+    return float(match.group(1)) if match else None
+
+
+class RateController:
+    """
+    Client-side AIMD (additive increase, multiplicative decrease) rate controller for the Google API.
+    The number of requests in flight is limited; the limit grows by one after a full window of successes,
+    only while the callers use all the slots (it does not grow under a light load), and is multiplied by `decrease` on each 429. During a backoff (Retry-After hint or exponential backoff),
+    all the callers sharing the controller wait, instead of retrying on their own.
+    If a SharedQuota is given, each attempt is also acquired from the quota shared with the other processes.
+    """
+
+    def __init__(self, initial_limit: float = 4, min_limit: float = 1, max_limit: float = 64, decrease: float = 0.5,
+                 max_retries: int = 8, base_delay: float = 1.0, max_delay: float = 120.0, quota: SharedQuota = None):
+
+        self.limit = initial_limit
+        self.min_limit, self.max_limit = min_limit, max_limit
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.base_delay, self.max_delay = base_delay, max_delay
+        self.quota = quota
+
+        self.in_flight = 0
+        self.saturated = False     # all the slots were taken since the last increase of the limit
+        self.blocked_until = 0.0   # no request is sent before this time (monotonic clock)
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+        self.n_requests, self.n_throttled, self.n_unavailable, self.n_retries = 0, 0, 0, 0
+        self.backoff_time = 0.0
+
+    # --- Slots of requests in flight ---
+
+    def _try_acquire(self) -> float:
+        """
+        Take a slot if possible and return 0, else return the time to wait before trying again
+        """
+        with self.condition:
+            wait = self.blocked_until - monotonic()
+            if wait > 0:
+                return wait
+            if self.in_flight < max(int(self.limit), 1):
+                self.in_flight += 1
+                self.n_requests += 1
+                self.saturated |= self.in_flight >= max(int(self.limit), 1)
+                return 0
+            self.saturated = True
+            return 0.05
+
+    def acquire(self):
+        while (wait := self._try_acquire()) > 0:
+            with self.condition:
+                self.condition.wait(timeout=wait)
+
+    async def acquire_async(self):
+        while (wait := self._try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    # --- AIMD ---
+
+    def on_success(self):
+        with self.condition:
+            if self.saturated:
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+                self.saturated = self.in_flight >= max(int(self.limit), 1)
+
+    def on_error(self, e, attempt: int) -> float:
+        """
+        Update the limit after a retriable error and return the backoff before the next attempt
+        """
+        hint = retry_after(e)
+        delay = hint if hint is not None else min(self.base_delay * 2 ** attempt, self.max_delay) * random.uniform(0.5, 1.0)
+
+        with self.condition:
+            now = monotonic()
+            if e.code == 429:
+                self.n_throttled += 1
+                # All the requests in flight may fail at once: decrease only once per congestion event
+                if now - self.last_decrease > delay:
+                    self.limit = max(self.limit * self.decrease, self.min_limit)
+                    self.last_decrease = now
+                    logger.debug(f"Rate limited by the Google API: limit={self.limit:0.1f}, backoff={delay:0.1f} sec")
+            else:
+                self.n_unavailable += 1
+
+            self.n_retries += 1
+            self.blocked_until = max(self.blocked_until, now + delay)
+            self.backoff_time += delay
+
+        return delay
+
+    # --- Calls ---
+
+    def call(self, fn, *args, _quota: tuple = None, **kwargs):
+        """
+        Call fn with retries on 429/503; `_quota` is the (api_key, model, tokens) to acquire from the shared quota
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.quota and _quota:
+                self.quota.acquire(*_quota)
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if (not is_retriable(e)) or (attempt == self.max_retries):
+                    raise
+                self.on_error(e, attempt)
+                continue
+            finally:
+                self.release()
+            self.on_success()
+            return result
+
+    async def call_async(self, fn, *args, _quota: tuple = None, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if self.quota and _quota:
+                await self.quota.acquire_async(*_quota)
+            await self.acquire_async()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if (not is_retriable(e)) or (attempt == self.max_retries):
+                    raise
+                self.on_error(e, attempt)
+                continue
+            finally:
+                self.release()
+            self.on_success()
+            return result
+
+    def stats(self) -> dict:
+        return {'limit': round(self.limit, 2), 'in_flight': self.in_flight, 'requests': self.n_requests,
+                'throttled': self.n_throttled, 'unavailable': self.n_unavailable, 'retries': self.n_retries,
+                'backoff_sec': round(self.backoff_time, 1),
+                'quota_wait_sec': round(self.quota.wait_time, 1) if self.quota else 0.0}
+
+
+# Controller shared by all the Gemini call sites of this process, and quota shared with the other processes
+rate_controller = RateController(quota=SharedQuota())
+
+
+def _quota_request(models, kwargs) -> tuple:
+    api_key = getattr(getattr(models, '_api_client', None), 'api_key', None) or ''
+    config = kwargs.get('config')
+    system_instruction = getattr(config, 'system_instruction', None) or ''
+    return api_key, kwargs.get('model', ''), estimate_tokens(str(system_instruction) + str(kwargs.get('contents', '')))
+
+
+def install_rate_controller(controller: RateController = rate_controller):
+    """
+    Route all the calls to generate_content and embed_content of genai (sync and async) through the controller
+    """
+    for cls, name, is_async in [(genai.models.Models, 'generate_content', False), (genai.models.Models, 'embed_content', False),
+                                (genai.models.AsyncModels, 'generate_content', True), (genai.models.AsyncModels, 'embed_content', True)]:
+        method = getattr(cls, name)
+        if hasattr(method, '__wrapped__'):
+            continue
+
+        if is_async:
+            @functools.wraps(method)
+            async def wrapper(self, *args, _method=method, **kwargs):
+                return await controller.call_async(_method, self, *args, _quota=_quota_request(self, kwargs), **kwargs)
+        else:
+            @functools.wraps(method)
+            def wrapper(self, *args, _method=method, **kwargs):
+                return controller.call(_method, self, *args, _quota=_quota_request(self, kwargs), **kwargs)
+
+        setattr(cls, name, wrapper)
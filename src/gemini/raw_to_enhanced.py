@@ -1,22 +1,28 @@
 import os
 import sys
-import json
 import yaml
 import click
-from tqdm import tqdm
+import asyncio
 from google import genai
-from loguru import logger
 
-from structured_output import structured_analysis, COMBINED_PROMPT
+from enrichment import enrich_messages
+from structured_output import context_caches
+from cascade import CASCADE_MODELS
 
 sys.path.append('..')
-from data_telegram.extractor import extract_message
+from data_telegram.journal import load_messages
 
 
 @click.command()
 @click.option('--datamap', help='Name of the datamap')
 @click.option('--account', help='Name of the account')
-def main(datamap, account):
+@click.option('--concurrency', default=8, show_default=True, help='Maximal number of requests in flight')
+@click.option('--batch-size', default=1, show_default=True, help='Number of messages packed in a single request')
+@click.option('--no-cache', is_flag=True, help='Do not use the persistent cache of analyses')
+@click.option('--no-dedup', is_flag=True, help='Do not detect duplicate messages before the enrichment')
+@click.option('--cascade', is_flag=True, help=f'Analyze with {CASCADE_MODELS[0]} first, and escalate the unreliable outputs to {CASCADE_MODELS[1]}')
+@click.option('--context-cache', is_flag=True, help='Store the instructions of the prompt in a context cache of the Google API')
+def main(datamap, account, concurrency, batch_size, no_cache, no_dedup, cascade, context_cache):
 
     # Login to the Google API
     config_path = os.path.join(os.path.dirname(__file__), '../../config.yaml')
@@ -30,54 +36,22 @@ def main(datamap, account):
         config = yaml.safe_load(f)
         REGION = config['map']['region']
         LANGUAGES = config['map']['languages']
+        BBOX = config['map'].get('bbox')
 
     client = genai.Client(api_key=GOOGLE_API_KEY)
+    context_caches.enabled = context_cache
 
-    # Create a Gemini file if it does not exist
-    if not os.path.exists(os.path.join('../../data/datamaps', datamap, account, 'gemini.json')):
+    # Load the messages, and the ones already enriched by a previous run
+    account_dir = os.path.join('../../data/datamaps', datamap, account)
+    messages, journal = load_messages(account_dir, account, method='gemini')
 
-        # Open the result.json
-        with open(os.path.join('../../data/datamaps', datamap, account, 'result.json'), encoding='utf-8') as file:
-            result = json.load(file)
+    # Enrich messages concurrently, each enriched message is appended to the journal
+    asyncio.run(enrich_messages(client, messages, region=REGION, languages=LANGUAGES, concurrency=concurrency, batch_size=batch_size, use_cache=not no_cache, dedup=not no_dedup,
+                                model_google=CASCADE_MODELS[0] if cascade else CASCADE_MODELS[1], escalate_model=CASCADE_MODELS[1] if cascade else None, bbox=BBOX,
+                                on_enriched=lambda i, message: journal.append(message), desc=f"Converting messages of {account}"))
 
-        # Extract raw messages
-        messages = [extract_message(m, account) for m in result['messages']]
-
-        # Save it as gemini.json
-        with open(os.path.join('../../data/datamaps', datamap, account, 'gemini.json'), 'w', encoding='utf-8') as file:
-            json.dump(messages, file, indent=4, ensure_ascii=False)  
-
-    # Open the gemini.json
-    with open(os.path.join('../../data/datamaps', datamap, account, 'gemini.json'), encoding='utf-8') as file:
-        messages = json.load(file)
-
-    # Iterate over messages
-    for i, message in tqdm(enumerate(messages), desc=f"Converting messages of {account}", leave=True, total=len(messages)):
-
-        if 'text_english' not in message:
-
-            if not message['text']:
-                messages[i] = message | {'text_english': '', 'geolocs': [], 'coordinates': [], 'negative': 0.0, 'neutral': 1.0, 'positive': 0.0}
-
-            else:
-
-                output = structured_analysis(client, message['text'], prompt_template=COMBINED_PROMPT, region=REGION, languages=LANGUAGES)
-                if output:
-                    messages[i] =  message | {'text_english': output['translation'], 
-                    'geolocs': [g['location_name'] for g in output['geolocations']], 
-                    'coordinates': [(g['latitude'], g['longitude']) for g in output['geolocations']], 
-                    'negative': output['sentiment']['negative'], 'neutral': output['sentiment']['neutral'], 'positive': output['sentiment']['positive']} 
-                else:
-                    logger.warning(f"None returned as output by Google API at message id {message['id']}")
-
-        # Early saving in case of an error
-        if i % 50 == 0:
-            with open(os.path.join('../../data/datamaps', datamap, account, 'gemini.json'), 'w', encoding='utf-8') as file:
-                json.dump(messages, file, indent=4, ensure_ascii=False)
-
-    # Save the final file
-    with open(os.path.join('../../data/datamaps', datamap, account, 'gemini.json'), 'w', encoding='utf-8') as file:
-        json.dump(messages, file, indent=4, ensure_ascii=False)
+    # Compact the journal into the final file
+    journal.compact(messages, os.path.join(account_dir, 'gemini.json'))
 
 
 if __name__ == '__main__':
@@ -11,6 +11,13 @@ from google.genai import types
 import chromadb
 from chromadb import Documents, EmbeddingFunction, Embeddings
 
+try:
+    from .dedup import cluster_near_duplicates
+    from .rate_control import install_rate_controller
+except ImportError:
+    from dedup import cluster_near_duplicates
+    from rate_control import install_rate_controller
+
 
 class GeminiEmbeddingSemanticSimilarity(EmbeddingFunction):
     """
@@ -57,13 +64,25 @@ class SimilaritySearch:
             embedding_function=self.embedding_function
             )
         
-    def add_documents(self, documents):
+    def add_documents(self, documents, dedup=True):
+
+        # Only embed one representative per cluster of near-duplicate documents, and copy its embedding to the others
+        representatives = cluster_near_duplicates(documents) if dedup else list(range(len(documents)))
+        unique = sorted(set(representatives))
+        logger.info(f"Near-duplicate detection: {len(unique)} documents to embed, {len(documents) - len(unique)} API calls saved")
 
-        # Add documents using batches
+        # Embed documents using batches
         # NB: using batch is necessary since the maximal load is 100 samples and that our dataset contains 1987 documents
-        for start in tqdm(range(0, len(documents), batch_size := 100)):
+        embeddings = {}
+        for start in tqdm(range(0, len(unique), batch_size := 100)):
+            batch = unique[start:start + batch_size]
+            embeddings.update(zip(batch, self.embedding_function([documents[i] for i in batch])))
+
+        # Add all documents, so that ids still match the position of the messages in the datamap
+        for start in range(0, len(documents), batch_size):
             end = min(start + batch_size, len(documents))
-            self.collection.add(documents=documents[start:end], ids=[str(i) for i in range(start, end)])
+            self.collection.add(documents=documents[start:end], ids=[str(i) for i in range(start, end)],
+                                embeddings=[embeddings[representatives[i]] for i in range(start, end)])
 
     def query(self, query: str, n_results: int = 5):
 
@@ -127,6 +146,9 @@ def main(datamap=None, query=None):
 
 
 if __name__ == "__main__":
+
+    # Retry on 429/503 with the rate controller of src/gemini
+    install_rate_controller()
     main()
 
 # uv run similarity_search.py --datamap sample                                                                     # build database on terminal 1
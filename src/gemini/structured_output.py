@@ -1,30 +1,41 @@
 import os
+import asyncio
 from google import genai
 from google.genai import types
-from google.api_core import retry
 import yaml
+from loguru import logger
+from time import perf_counter
 import typing_extensions as typing
 
-def is_retriable(e):
-    return isinstance(e, genai.errors.APIError) and e.code in {429, 503}
+try:
+    from .cache import AnalysisCache, get_cache
+    from .quota import estimate_tokens
+    from .rate_control import install_rate_controller
+    from .preclassifier import preclassify as _classify, preclassifier_stats
+except ImportError:
+    from cache import AnalysisCache, get_cache
+    from quota import estimate_tokens
+    from rate_control import install_rate_controller
+    from preclassifier import preclassify as _classify, preclassifier_stats
 
-if not hasattr(genai.models.Models.generate_content, '__wrapped__'):
-  genai.models.Models.generate_content = retry.Retry(
-      predicate=is_retriable)(genai.models.Models.generate_content)
+# Retries on 429/503 are handled by the AIMD rate controller shared by all the Gemini call sites
+install_rate_controller()
 
 
-COMBINED_PROMPT = """
+PROMPT_HEADER = """
 You are a multifunctional assistant capable of translating, geolocating, and analyzing sentiment from a given Telegram post.
 These messages on posted on channels based in this region: {region}.
 
-Telegram Message:
+"""
+
+MESSAGE_PROMPT = """Telegram Message:
 ```
 {text}
 ```
 
-Tasks:
+"""
 
-1. Translation:
+TRANSLATION_TASK = """1. Translation:
     a. Identify the language of the post. It could be in these languages: {languages}.
     b. Translate the post to English accurately.
     c. Maintain the original formatting, including paragraph breaks, lists, and emphasis.
@@ -32,7 +43,9 @@ Tasks:
     e. Preserve the tone of the post, whether it is formal, informal, or conversational.
     f. Return only the translated post and not the language
 
-2. Geolocation:
+"""
+
+GEOLOCATION_TASK = """2. Geolocation:
     a. Read carefully to find any current factual events. Ignore speeches and announcements. Ignore very old events and future events.
     b. Read the post carefully to identify any mentioned locations, such as cities, landmarks, or addresses.
     c. Find the location (most precise if many) of the factual event based on the context provided.
@@ -78,18 +91,47 @@ Output for geolocation task:
 [("Jerusalem", 31.777, 35.232)]
 Explanation: Only the events that recently happened are geolocated.
 
-3. Sentiment Analysis:
+"""
+
+SENTIMENT_TASK = """3. Sentiment Analysis:
     a. Read the message carefully to understand its content and tone.
     b. Evaluate the sentiment of the message.
     c. Return only the three probabilities as a tuple without any explanation
     d. Ensure the probabilities sum up to 1.0.
 
-Output:
+"""
+
+PROMPT_TASKS = "Tasks:\n\n" + TRANSLATION_TASK + GEOLOCATION_TASK + SENTIMENT_TASK + """Output:
 - translation: str
 - geolocation: [(location_name: str, latitude: float, longitude: float)]
 - sentiment: (negative: float, neutral: float, positive: float)
 """
 
+COMBINED_PROMPT = PROMPT_HEADER + MESSAGE_PROMPT + PROMPT_TASKS
+
+# Posts already in English do not need any translation
+ENGLISH_PROMPT = PROMPT_HEADER + MESSAGE_PROMPT + "Tasks:\n\n" + GEOLOCATION_TASK.replace('2. Geolocation', '1. Geolocation') + \
+  SENTIMENT_TASK.replace('3. Sentiment', '2. Sentiment') + """Output:
+- geolocation: [(location_name: str, latitude: float, longitude: float)]
+- sentiment: (negative: float, neutral: float, positive: float)
+"""
+
+# Translation only, for the low-priority posts of the live under backlog
+TRANSLATION_PROMPT = PROMPT_HEADER + MESSAGE_PROMPT + "Tasks:\n\n" + TRANSLATION_TASK + """Output:
+- translation: str
+"""
+
+# Several posts are packed in a single request: the instructions and examples are only sent once
+BATCH_MESSAGES_PROMPT = """Telegram Messages (each one is preceded by its message_id):
+{text}
+
+"""
+
+BATCH_PROMPT = PROMPT_HEADER + BATCH_MESSAGES_PROMPT + PROMPT_TASKS + """
+Apply these tasks to each Telegram message independently.
+Return a list with exactly one output per Telegram message, including its message_id.
+"""
+
 
 class Geoloc(typing.TypedDict):
   location_name: str
@@ -106,21 +148,372 @@ class StructuredAnalysis(typing.TypedDict):
   geolocations: list[Geoloc]
   sentiment: Sentiment
 
+class EnglishAnalysis(typing.TypedDict):
+  geolocations: list[Geoloc]
+  sentiment: Sentiment
+
+class TranslationAnalysis(typing.TypedDict):
+  translation: str
+
+class BatchAnalysis(typing.TypedDict):
+  message_id: int
+  translation: str
+  geolocations: list[Geoloc]
+  sentiment: Sentiment
+
+
+class UsageStats:
+  """
+  Count the requests and tokens sent to Gemini, to compare the prompting strategies
+  """
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.requests = 0
+    self.messages = 0
+    self.prompt_tokens = 0
+    self.cached_tokens = 0
+    self.output_tokens = 0
+    self.start = perf_counter()
+
+  def record(self, response, n_messages: int = 1):
+    self.requests += 1
+    self.messages += n_messages
+    metadata = response.usage_metadata
+    if metadata:
+      prompt_tokens, cached_tokens = metadata.prompt_token_count or 0, metadata.cached_content_token_count or 0
+      output_tokens = metadata.candidates_token_count or 0
+      self.prompt_tokens += prompt_tokens
+      self.cached_tokens += cached_tokens
+      self.output_tokens += output_tokens
+      logger.debug(f"Tokens for {n_messages} message(s): {prompt_tokens} prompt ({cached_tokens} cached), {output_tokens} output")
+
+  def summary(self) -> str:
+    n_messages, minutes = max(self.messages, 1), max(perf_counter() - self.start, 1e-9) / 60
+    return (f"{self.requests} requests for {self.messages} messages: "
+            f"{self.prompt_tokens / n_messages:0.0f} prompt tokens/message (including {self.cached_tokens / n_messages:0.0f} cached), "
+            f"{self.output_tokens / n_messages:0.0f} output tokens/message, {self.requests / minutes:0.1f} requests/min")
+
+usage = UsageStats()
+
+
+def split_prompt(prompt_template: str) -> tuple[str, str]:
+  """
+  Split a prompt template into its static instructions (with the examples) and the part containing the post(s).
+  The static instructions only depend on the region and the languages of the datamap, so they are sent as
+  a system instruction (or a cached context) and only the post varies between the requests.
+  """
+  for message_prompt in (MESSAGE_PROMPT, BATCH_MESSAGES_PROMPT):
+    if message_prompt in prompt_template:
+      return prompt_template.replace(message_prompt, ''), message_prompt
+  return '', prompt_template  # unknown template: everything is sent in the contents
+
+
+class ContextCaches:
+  """
+  Explicit context caches of the Google API holding the static instructions, by (instructions, model).
+  Disabled by default: the models require a minimal number of tokens to cache a context, so a model
+  or a prompt that cannot be cached falls back to the system instruction.
+  """
+
+  def __init__(self, enabled: bool = False, ttl: int = 3600):
+    self.enabled = enabled
+    self.ttl = ttl
+    self.caches = {}        # (instructions, model) -> (name, expiration time)
+    self.unsupported = set()
+
+  def _lookup(self, instructions: str, model: str):
+    if (not self.enabled) or (not instructions) or ((instructions, model) in self.unsupported):
+      return False, None
+    name, expiration = self.caches.get((instructions, model), (None, 0))
+    if perf_counter() < expiration - 60:
+      return False, name
+    return True, None
+
+  def _created(self, instructions: str, model: str, cached_content) -> str:
+    self.caches[(instructions, model)] = (cached_content.name, perf_counter() + self.ttl)
+    logger.info(f"Context cache {cached_content.name} created for {model}")
+    return cached_content.name
+
+  def _failed(self, instructions: str, model: str, e) -> None:
+    logger.warning(f"Cannot cache the instructions for {model}, use a system instruction instead: {e}")
+    self.unsupported.add((instructions, model))
+
+  def _config(self, instructions: str):
+    return types.CreateCachedContentConfig(system_instruction=instructions, ttl=f'{self.ttl}s')
+
+  def get(self, client, instructions: str, model: str):
+    """
+    Return the name of the cached context of the instructions (created if needed), or None
+    """
+    to_create, name = self._lookup(instructions, model)
+    if not to_create:
+      return name
+    try:
+      return self._created(instructions, model, client.caches.create(model=model, config=self._config(instructions)))
+    except genai.errors.APIError as e:
+      return self._failed(instructions, model, e)
+
+  async def aget(self, client, instructions: str, model: str):
+    to_create, name = self._lookup(instructions, model)
+    if not to_create:
+      return name
+    try:
+      return self._created(instructions, model, await client.aio.caches.create(model=model, config=self._config(instructions)))
+    except genai.errors.APIError as e:
+      return self._failed(instructions, model, e)
+
+context_caches = ContextCaches()
 
-def structured_analysis(client, text: str, prompt_template: str, region: str, languages: str, model_google='gemini-2.0-flash'):
 
-  structured_output_config = types.GenerateContentConfig(
+def _structured_output_config(response_schema, system_instruction=None, cached_content=None):
+  return types.GenerateContentConfig(
       temperature=0.1,
       response_mime_type="application/json",
-      response_schema=StructuredAnalysis,
+      response_schema=response_schema,
+      system_instruction=None if cached_content else (system_instruction or None),
+      cached_content=cached_content,
   )
+
+def _prepare(prompt_template: str, text: str, region: str, languages: str) -> tuple[str, str]:
+  """
+  Return the static instructions and the contents of a request
+  """
+  instructions, message_prompt = split_prompt(prompt_template)
+  return instructions.format(region=region, languages=languages), message_prompt.format(text=text, region=region, languages=languages)
+
+
+# Geolocations and sentiment of a post that is not analyzed (e.g. translation only)
+NO_ANALYSIS = {'geolocations': [], 'sentiment': {'negative': 0.0, 'neutral': 1.0, 'positive': 0.0}}
+
+PROMPT_SCHEMAS = {ENGLISH_PROMPT: EnglishAnalysis, TRANSLATION_PROMPT: TranslationAnalysis}
+
+def _preclassify(text: str, prompt_template: str):
+  """
+  Local pre-pass of COMBINED_PROMPT and TRANSLATION_PROMPT: return a canned analysis for a trivial post (or None),
+  and the prompt and schema to use (without translation for a post already in English)
+  """
+  response_schema = PROMPT_SCHEMAS.get(prompt_template, StructuredAnalysis)
+  if prompt_template not in (COMBINED_PROMPT, TRANSLATION_PROMPT):
+    return None, prompt_template, response_schema
+
+  kind, output = _classify(text)
+  preclassifier_stats.record(kind)
+  if (kind == 'english') and (prompt_template == TRANSLATION_PROMPT):
+    return {'translation': text} | NO_ANALYSIS, prompt_template, response_schema
+  if kind == 'english':
+    return None, ENGLISH_PROMPT, EnglishAnalysis
+  return output, prompt_template, response_schema
+
+def _parsed(response, text: str, response_schema):
+  if not response.parsed:
+    return response.parsed
+  if response_schema is EnglishAnalysis:
+    return {'translation': text} | response.parsed
+  if response_schema is TranslationAnalysis:
+    return response.parsed | NO_ANALYSIS
+  return response.parsed
+
+
+def structured_analysis(client, text: str, prompt_template: str, region: str, languages: str, model_google='gemini-2.0-flash', use_cache=True, preclassify=True):
+
+  # Trivial posts do not need any request, posts in English do not need any translation
+  output, prompt_template, response_schema = _preclassify(text, prompt_template) if preclassify else (None, prompt_template, PROMPT_SCHEMAS.get(prompt_template, StructuredAnalysis))
+  if output is not None:
+    return output
+
+  # Check the persistent cache first
+  key = AnalysisCache.make_key(text, prompt_template, region, languages, model_google)
+  if use_cache and (output := get_cache().get(key)) is not None:
+    return output
+
+  instructions, contents = _prepare(prompt_template, text, region, languages)
   response = client.models.generate_content(
       model=model_google,
-      config=structured_output_config,
-      contents=[prompt_template.format(text=text, region=region, languages=languages)],
+      config=_structured_output_config(response_schema, instructions, context_caches.get(client, instructions, model_google)),
+      contents=[contents],
   )
+  usage.record(response)
+  output = _parsed(response, text, response_schema)
 
-  return response.parsed
+  if use_cache:
+    get_cache().put(key, output)
+  return output
+
+
+async def async_structured_analysis(client, text: str, prompt_template: str, region: str, languages: str, model_google='gemini-2.0-flash', use_cache=True, budget=None, preclassify=True):
+  """
+  Same as structured_analysis, but using the async client of genai (client.aio).
+  If a QuotaBudget (or QuotaBudgets) is given, the request waits until it fits in the budget of its model.
+  """
+
+  # Trivial posts do not need any request, posts in English do not need any translation
+  output, prompt_template, response_schema = _preclassify(text, prompt_template) if preclassify else (None, prompt_template, PROMPT_SCHEMAS.get(prompt_template, StructuredAnalysis))
+  if output is not None:
+    return output
+
+  # Check the persistent cache first
+  key = AnalysisCache.make_key(text, prompt_template, region, languages, model_google)
+  if use_cache and (output := await get_cache().aget(key)) is not None:
+    return output
+
+  instructions, contents = _prepare(prompt_template, text, region, languages)
+  cached_content = await context_caches.aget(client, instructions, model_google)
+  if budget:
+    await budget.acquire(estimate_tokens(contents if cached_content else instructions + contents), model=model_google)
+
+  response = await client.aio.models.generate_content(
+      model=model_google,
+      config=_structured_output_config(response_schema, instructions, cached_content),
+      contents=[contents],
+  )
+  usage.record(response)
+  output = _parsed(response, text, response_schema)
+
+  if use_cache:
+    await get_cache().aput(key, output)
+  return output
+
+
+def _format_batch(posts: dict[int, str]) -> str:
+  return '\n'.join(f"message_id: {message_id}\n```\n{text}\n```" for message_id, text in posts.items())
+
+def _map_batch(parsed, posts: dict[int, str]) -> dict[int, StructuredAnalysis]:
+  """
+  Map the outputs of a batch back to their posts; unknown and incomplete outputs are ignored
+  """
+  results = {}
+  for item in parsed or []:
+    message_id = item.get('message_id')
+    if (message_id in posts) and (message_id not in results) and all(k in item for k in StructuredAnalysis.__annotations__):
+      results[message_id] = {k: item[k] for k in StructuredAnalysis.__annotations__}
+  return results
+
+
+def _canned_batch(posts: dict[int, str]):
+  """
+  Split a batch into the canned outputs of the trivial posts and the posts to analyze.
+  Posts in English stay in the batch, which already sends the instructions only once.
+  """
+  results, remaining = {}, {}
+  for message_id, text in posts.items():
+    kind, output = _classify(text)
+    preclassifier_stats.record('trivial' if output is not None else 'batched')
+    if output is not None:
+      results[message_id] = output
+    else:
+      remaining[message_id] = text
+  return results, remaining
+
+def _cached_batch(posts: dict[int, str], region: str, languages: str, model_google: str):
+  """
+  Split a batch into the outputs found in the cache and the posts still to analyze.
+  An output from a batch is cached as an output of COMBINED_PROMPT, so both modes share the cache.
+  """
+  cache, results, remaining = get_cache(), {}, {}
+  for message_id, text in posts.items():
+    output = cache.get(AnalysisCache.make_key(text, COMBINED_PROMPT, region, languages, model_google))
+    if output is not None:
+      results[message_id] = output
+    else:
+      remaining[message_id] = text
+  return results, remaining
+
+def _cache_batch(results: dict[int, StructuredAnalysis], posts: dict[int, str], region: str, languages: str, model_google: str):
+  cache = get_cache()
+  for message_id, output in results.items():
+    cache.put(AnalysisCache.make_key(posts[message_id], COMBINED_PROMPT, region, languages, model_google), output)
+
+
+def structured_analysis_batch(client, posts: dict[int, str], region: str, languages: str, prompt_template: str = BATCH_PROMPT, model_google='gemini-2.0-flash', use_cache=True, preclassify=True) -> dict[int, StructuredAnalysis]:
+  """
+  Analyze K posts in a single request, so that the instructions and examples are sent only once.
+  Posts missing from the reply are analyzed one by one with COMBINED_PROMPT.
+  Args:
+      posts (dict[int, str]): texts of the posts by id (e.g. message id)
+  Returns:
+      dict[int, StructuredAnalysis]: outputs by id (None if the single-message call also failed)
+  """
+  # Only send the posts that are neither trivial nor in the persistent cache
+  canned, posts = _canned_batch(posts) if preclassify else ({}, posts)
+  cached, posts = _cached_batch(posts, region, languages, model_google) if use_cache else ({}, posts)
+  cached = canned | cached
+  if not posts:
+    return cached
+
+  instructions, contents = _prepare(prompt_template, _format_batch(posts), region, languages)
+  response = client.models.generate_content(
+      model=model_google,
+      config=_structured_output_config(list[BatchAnalysis], instructions, context_caches.get(client, instructions, model_google)),
+      contents=[contents],
+  )
+  results = _map_batch(response.parsed, posts)
+  usage.record(response, n_messages=len(results))
+  if use_cache:
+    _cache_batch(results, posts, region, languages, model_google)
+
+  missing = [message_id for message_id in posts if message_id not in results]
+  if missing:
+    logger.warning(f"{len(missing)}/{len(posts)} messages missing from the batch reply, fall back to single-message calls")
+  for message_id in missing:
+    results[message_id] = structured_analysis(client, posts[message_id], COMBINED_PROMPT, region, languages, model_google=model_google, use_cache=use_cache, preclassify=False)
+
+  return cached | results
+
+
+async def async_structured_analysis_batch(client, posts: dict[int, str], region: str, languages: str, prompt_template: str = BATCH_PROMPT, model_google='gemini-2.0-flash', use_cache=True, budget=None, preclassify=True) -> dict[int, StructuredAnalysis]:
+  """
+  Same as structured_analysis_batch, but using the async client of genai (client.aio).
+  If a QuotaBudget (or QuotaBudgets) is given, the request waits until it fits in the budget of its model.
+  """
+  # Only send the posts that are neither trivial nor in the persistent cache
+  canned, posts = _canned_batch(posts) if preclassify else ({}, posts)
+  cached, posts = await asyncio.to_thread(_cached_batch, posts, region, languages, model_google) if use_cache else ({}, posts)
+  cached = canned | cached
+  if not posts:
+    return cached
+
+  instructions, contents = _prepare(prompt_template, _format_batch(posts), region, languages)
+  cached_content = await context_caches.aget(client, instructions, model_google)
+  if budget:
+    await budget.acquire(estimate_tokens(contents if cached_content else instructions + contents), model=model_google)
+
+  response = await client.aio.models.generate_content(
+      model=model_google,
+      config=_structured_output_config(list[BatchAnalysis], instructions, cached_content),
+      contents=[contents],
+  )
+  results = _map_batch(response.parsed, posts)
+  usage.record(response, n_messages=len(results))
+  if use_cache:
+    await asyncio.to_thread(_cache_batch, results, posts, region, languages, model_google)
+
+  missing = [message_id for message_id in posts if message_id not in results]
+  if missing:
+    logger.warning(f"{len(missing)}/{len(posts)} messages missing from the batch reply, fall back to single-message calls")
+  outputs = await asyncio.gather(*(
+      async_structured_analysis(client, posts[message_id], COMBINED_PROMPT, region, languages, model_google=model_google, use_cache=use_cache, budget=budget, preclassify=False)
+      for message_id in missing))
+  results.update(zip(missing, outputs))
+
+  return cached | results
+
+
+# Enhanced fields of a message without any text
+EMPTY_ANALYSIS = {'text_english': '', 'geolocs': [], 'coordinates': [], 'negative': 0.0, 'neutral': 1.0, 'positive': 0.0}
+
+def format_output(output: StructuredAnalysis) -> dict:
+  """
+  Convert a structured analysis into the enhanced fields of a message
+  """
+  return {'text_english': output['translation'],
+          'geolocs': [g['location_name'] for g in output['geolocations']],
+          'coordinates': [(g['latitude'], g['longitude']) for g in output['geolocations']],
+          'negative': output['sentiment']['negative'],
+          'neutral': output['sentiment']['neutral'],
+          'positive': output['sentiment']['positive']}
 
 if __name__ == '__main__':
     config_path = os.path.join(os.path.dirname(__file__), '../../config.yaml')
@@ -0,0 +1,191 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telethon import errors
+
+from src.data_telegram.live_ingestion import LiveIngestion, backfill, backfill_channel
+from src.data_telegram.store import LiveStore
+
+
+def make_message(id, text='', grouped_id=None, photo=False, video=False):
+    """
+    Fake Telethon message, with the attributes read by LiveIngestion
+    """
+    return SimpleNamespace(id=id, message=text, grouped_id=grouped_id, photo=object() if photo else None, video=object() if video else None,
+                           date=datetime(2025, 1, 1, 12, 0, id % 60, tzinfo=timezone.utc))
+
+
+class FakeClient:
+    """
+    Fake Telethon client serving the messages of its channels, which raises a FloodWaitError
+    after `flood_after` messages the first time they are iterated
+    """
+
+    def __init__(self, channels: dict[str, list], flood_after: int = None, flood_seconds: int = 7):
+        self.channels = channels
+        self.flood_after = flood_after
+        self.flood_seconds = flood_seconds
+        self.calls = []  # (channel, min_id) of each call to iter_messages
+
+    async def get_entity(self, channel):
+        return channel
+
+    async def iter_messages(self, entity, min_id=0, reverse=False):
+        self.calls.append((entity, min_id))
+        messages = sorted((m for m in self.channels[entity] if m.id > min_id), key=lambda m: m.id, reverse=not reverse)
+        for k, message in enumerate(messages):
+            if (self.flood_after is not None) and (k == self.flood_after):
+                self.flood_after = None
+                raise errors.FloodWaitError(request=None, capture=self.flood_seconds)
+            yield message
+
+
+def drain(queue: asyncio.PriorityQueue) -> list[dict]:
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait()[2])
+    return items
+
+
+def test_album_parts_are_merged():
+
+    async def run():
+        queue = asyncio.PriorityQueue()
+        ingestion = LiveIngestion(queue, 'UTC', album_window=0.05)
+        await ingestion.put(make_message(11, grouped_id=7, video=True), 'channel')
+        await ingestion.put(make_message(10, 'Caption', grouped_id=7, photo=True), 'channel')
+        await ingestion.put(make_message(12, 'More', grouped_id=7), 'channel')
+        assert queue.empty()  # the album waits for the end of its window
+
+        await asyncio.sleep(0.1)
+        return drain(queue), ingestion
+
+    items, ingestion = asyncio.run(run())
+    assert len(items) == 1
+    assert items[0]['id'] == 12
+    assert items[0]['text'] == 'Caption\nMore'
+    assert items[0]['has_photo'] and items[0]['has_video']
+    assert ingestion.n_merged == 2
+
+
+def test_album_part_after_the_window_is_not_merged():
+
+    async def run():
+        queue = asyncio.PriorityQueue()
+        ingestion = LiveIngestion(queue, 'UTC', album_window=0.05)
+        await ingestion.put(make_message(20, 'Caption', grouped_id=8, photo=True), 'channel')
+        await asyncio.sleep(0.01)
+        await ingestion.put(make_message(21, grouped_id=8, photo=True), 'channel')  # within the window
+        await asyncio.sleep(0.1)
+        await ingestion.put(make_message(22, 'Late', grouped_id=8, video=True), 'channel')  # after the window
+        await asyncio.sleep(0.1)
+        return drain(queue), ingestion
+
+    items, ingestion = asyncio.run(run())
+    assert [(item['id'], item['text']) for item in items] == [(21, 'Caption'), (22, 'Late')]
+    assert ingestion.n_merged == 1
+
+
+def test_duplicates_are_put_once():
+
+    async def run():
+        queue = asyncio.PriorityQueue()
+        ingestion = LiveIngestion(queue, 'UTC', watermarks={'channel': 5})
+        results = [await ingestion.put(make_message(6, 'a'), 'channel'),
+                   await ingestion.put(make_message(6, 'a'), 'channel'),     # received twice (live and backfill)
+                   await ingestion.put(make_message(4, 'old'), 'channel'),   # already written before the restart
+                   await ingestion.put(make_message(6, 'b'), 'other')]       # same id on another channel
+        return results, drain(queue)
+
+    results, items = asyncio.run(run())
+    assert results == [True, False, False, True]
+    assert [(item['account'], item['id']) for item in items] == [('channel', 6), ('other', 6)]
+
+
+def test_seen_ids_are_bounded_by_the_watermark():
+
+    async def run():
+        ingestion = LiveIngestion(asyncio.PriorityQueue(), 'UTC')
+        for id in range(1, 101):
+            await ingestion.put(make_message(id, 'a'), 'channel')
+        ingestion.written([{'account': 'channel', 'id': id} for id in range(1, 51)] + [{'account': 'channel', 'id': 80}])
+        return ingestion, await ingestion.put(make_message(30, 'a'), 'channel')
+
+    ingestion, put_again = asyncio.run(run())
+    assert ingestion.watermarks['channel'] == 50
+    assert ingestion.seen['channel'] == set(range(51, 101))
+    assert not put_again
+
+
+def test_backfill_channel_retries_after_flood_wait(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    async def run():
+        client = FakeClient({'channel': [make_message(id, f'm{id}') for id in range(1, 11)]}, flood_after=3)
+        queue = asyncio.PriorityQueue()
+        ingestion = LiveIngestion(queue, 'UTC')
+        monkeypatch.setattr(asyncio, 'sleep', fake_sleep)
+        n_messages = await backfill_channel(client, ingestion, 'channel', min_id=4)
+        return n_messages, drain(queue), client.calls
+
+    n_messages, items, calls = asyncio.run(run())
+    assert sleeps == [7]
+    assert calls == [('channel', 4), ('channel', 7)]  # resumed after the last message fetched
+    assert n_messages == 6
+    assert [item['id'] for item in items] == [5, 6, 7, 8, 9, 10]
+
+
+def test_backfill_resumes_from_the_store(tmp_path):
+    store = LiveStore(str(tmp_path / 'live.sqlite'))
+
+    # Message 3 was put before message 4, but the crash happened before it was written
+    async def live():
+        ingestion = LiveIngestion(asyncio.PriorityQueue(), 'UTC')
+        for id in [1, 2, 3, 4]:
+            await ingestion.put(make_message(id, f'm{id}'), 'channel')
+        for id in [1, 2, 4]:
+            store.append({'account': 'channel', 'id': id, 'date': f'2025-01-01 12:00:0{id}', 'text': f'm{id}'})
+        store.flush(ingestion.written)
+
+    asyncio.run(live())
+    assert store.last_ids() == {'channel': 2}
+
+    async def restart():
+        client = FakeClient({'channel': [make_message(id, f'm{id}') for id in range(1, 7)]})
+        queue = asyncio.PriorityQueue()
+        n_messages = await backfill(client, LiveIngestion(queue, 'UTC', watermarks=store.last_ids()), ['channel', 'unknown'], store.last_ids())
+        return n_messages, drain(queue), client.calls
+
+    n_messages, items, calls = asyncio.run(restart())
+    assert calls == [('channel', 2)]  # channels never seen by the live are not backfilled
+    assert n_messages == 4
+    assert [item['id'] for item in items] == [3, 4, 5, 6]
+    store.close()
+
+
+def test_watermark_waits_for_the_backfill(tmp_path):
+    store = LiveStore(str(tmp_path / 'live.sqlite'))
+
+    async def run():
+        ingestion = LiveIngestion(asyncio.PriorityQueue(), 'UTC', watermarks={'channel': 10})
+        ingestion.hold('channel', 10)
+
+        # A new message is written before the backfill fetched the messages 11 to 19
+        await ingestion.put(make_message(20, 'new'), 'channel')
+        store.append({'account': 'channel', 'id': 20, 'date': '2025-01-01 12:00:20', 'text': 'new'})
+        store.flush(ingestion.written)
+        held = store.last_ids()
+
+        client = FakeClient({'channel': [make_message(id, f'm{id}') for id in range(11, 21)]})
+        n_messages = await backfill_channel(client, ingestion, 'channel', min_id=10)
+        return held, n_messages, ingestion
+
+    held, n_messages, ingestion = asyncio.run(run())
+    assert held == {'channel': 10}
+    assert n_messages == 9  # the message 20 is not put twice
+    assert ingestion.watermarks['channel'] == 10  # the messages fetched are not written yet
+    store.close()
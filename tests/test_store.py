@@ -0,0 +1,21 @@
+from src.data_telegram.store import LiveStore
+
+
+def make_record(id, text, account='channel'):
+    return {'account': account, 'id': id, 'date': f'2025-01-01 12:00:{id:02d}', 'text': text}
+
+
+def test_read_since_tells_replacements_from_new_messages(tmp_path):
+    store = LiveStore(str(tmp_path / 'live.sqlite'))
+    store.write([make_record(1, 'a'), make_record(2, 'b')])
+    messages, last_rowid, replaced = store.read_since(0)
+    assert [m['id'] for m in messages] == [1, 2]
+    assert replaced == set()
+
+    # Message 1 was already read, message 3 is new even if written twice since the last read
+    store.write([make_record(3, 'c'), make_record(1, 'a2')])
+    store.write([make_record(1, 'a3'), make_record(3, 'c2')])
+    messages, _, replaced = store.read_since(last_rowid)
+    assert [(m['id'], m['text']) for m in messages] == [(1, 'a3'), (3, 'c2')]
+    assert replaced == {('channel', 1)}
+    store.close()